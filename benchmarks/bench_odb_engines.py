@@ -0,0 +1,101 @@
+"""Compare time and memory of the pandas and numpy ODB engines.
+
+A synthetic AMSU-A radiance base is written and converted with both engines:
+
+    python benchmarks/bench_odb_engines.py --nobs 200000
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyodc as odc
+
+from obsmontools.odb import get_obsmon_data_from_odb_files
+from obsmontools.obsmon import write_obsmon_sqlite_file
+
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "obsmontools", "data")
+
+
+def write_radiance_odb(odb_file, nobs, satelite_ids, seed=0):
+    """Write a synthetic AMSU-A base."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "obstype@hdr": np.full(nobs, 7, dtype=np.int32),
+        "codetype@hdr": np.full(nobs, 210, dtype=np.int32),
+        "varno@body": np.full(nobs, 119, dtype=np.int32),
+        "sensor@hdr": np.full(nobs, 3, dtype=np.int32),
+        "satellite_identifier@sat": rng.choice(satelite_ids, nobs).astype(np.int32),
+        "vertco_reference_1@body": rng.integers(1, 16, nobs).astype(np.int32),
+        "statid@hdr": ["   noaa"] * nobs,
+        "lat@hdr": rng.uniform(50, 70, nobs),
+        "lon@hdr": rng.uniform(0, 30, nobs),
+        "obsvalue@body": rng.normal(230, 10, nobs),
+        "fg_depar@body": rng.normal(0, 1, nobs),
+        "an_depar@body": rng.normal(0, 0.5, nobs),
+        "biascorr@body": rng.normal(0, 0.2, nobs),
+        "datum_status@body": rng.choice([1, 3, 4, 5, 12], nobs).astype(np.int32),
+        "lsm@modsurf": rng.choice([0.0, 1.0, 0.5], nobs),
+        "datum_anflag@body": np.zeros(nobs, dtype=np.int32),
+    })
+    odc.encode_odb(df, odb_file)
+
+
+def run(engine, run_settings, config, odb_config, datapath, output):
+    """Convert with one engine.
+
+    Returns:
+        tuple: Time (s) and peak memory (MB) for the views and for the write.
+
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    obsmon_data, obsmon_vars = get_obsmon_data_from_odb_files(
+        run_settings, config, odb_config, datapath, "odb", engine=engine
+    )
+    decoded = time.perf_counter()
+    views_peak = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.reset_peak()
+    write_obsmon_sqlite_file(obsmon_data, obsmon_vars, "2025110512", output)
+    end = time.perf_counter()
+    write_peak = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+    return decoded - start, views_peak, end - decoded, write_peak
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser("bench_odb_engines")
+    parser.add_argument("--nobs", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    with open(f"{DATA}/obsmon_config.json", mode="r", encoding="utf8") as fhandler:
+        config = json.load(fhandler)
+    with open(f"{DATA}/odb_config.json", mode="r", encoding="utf8") as fhandler:
+        odb_config = json.load(fhandler)
+    run_settings = {"mwrad": ["amsua"]}
+    satelite_ids = [odb_config["satelites"][sat]["id"] for sat in config["amsua"]["satelites"]]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_radiance_odb(f"{tmpdir}/mwrad.odb", args.nobs, satelite_ids)
+        print(
+            f"{'engine':8s} {'views (s)':>10s} {'views (MB)':>11s} "
+            f"{'write (s)':>10s} {'write (MB)':>11s}"
+        )
+        for engine in ["pandas", "numpy"]:
+            views, views_peak, write, write_peak = run(
+                engine, run_settings, config, odb_config, tmpdir, f"{tmpdir}/{engine}.db"
+            )
+            print(f"{engine:8s} {views:10.2f} {views_peak:11.1f} {write:10.2f} {write_peak:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
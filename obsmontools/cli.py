@@ -1,13 +1,36 @@
 """Command line interface"""
-import os
 import sys
 import json
+import logging
 import argparse
-from contextlib import suppress
-import pandas as pd
 
-from .odb import get_odb_data_from_file, ODBObsmonData, ODBObsmonVariable
-from .obsmon import write_obsmon_sqlite_file, ObsmonVariable
+from .odb import get_obsmon_data_from_odb_files
+from .obsmon import (
+    write_obsmon_sqlite_file, ObsmonVariable, open_db, close_db, create_db, usage_to_obsmon,
+    MODES, STAT_COLS
+)
+from .daemon import ObsmonDaemon, send_command
+
+
+def read_odb2sqlite_config(run_settings_file, config_file, odb_config_file):
+    """Read the configuration files for odb2sqlite.
+
+    Args:
+        run_settings_file (str): Run settings file.
+        config_file (str): Obsmon config file.
+        odb_config_file (str): ODB config file.
+
+    Returns:
+        tuple: Run settings, obsmon config and ODB config.
+
+    """
+    with open(run_settings_file, mode="r", encoding="utf8") as fhandler:
+        run_settings = json.load(fhandler)
+    with open(config_file, mode="r", encoding="utf8") as fhandler:
+        config = json.load(fhandler)
+    with open(odb_config_file, mode="r", encoding="utf8") as fhandler:
+        odb_config = json.load(fhandler)
+    return run_settings, config, odb_config
 
 
 def cmd_args_odb2sqlite(argv):
@@ -28,6 +51,10 @@ def cmd_args_odb2sqlite(argv):
     parser.add_argument("--suffix", dest="suffix", type=str)
     parser.add_argument("--dtg", dest="dtg", type=str)
     parser.add_argument("--output", dest="output", type=str)
+    parser.add_argument("--engine", dest="engine", type=str, default="pandas",
+                        choices=["pandas", "numpy"])
+    parser.add_argument("--concurrent", dest="concurrent", action="store_true", default=False,
+                        help="Stage the rows and publish them to a shared output data base")
 
     if len(argv) == 0:
         parser.print_help()
@@ -59,57 +86,169 @@ def odb2sqlite(argv=None):
     suffix = kwargs["suffix"]
     dtg = kwargs["dtg"]
     output_file = kwargs["output"]
+    engine = kwargs["engine"]
+    concurrent = kwargs["concurrent"]
+
+    run_settings, config, odb_config = read_odb2sqlite_config(
+        run_settings_file, config_file, odb_config_file
+    )
+    obsmon_data, obsmon_vars = get_obsmon_data_from_odb_files(
+        run_settings, config, odb_config, datapath, suffix, engine=engine
+    )
+    if obsmon_data is not None:
+        write_obsmon_sqlite_file(
+            obsmon_data, obsmon_vars, dtg, output_file, concurrent=concurrent
+        )
 
-    obsmon_data = None
-    obsmon_vars = []
-    with open(run_settings_file, mode="r", encoding="utf8") as fhandler:
-        data = json.load(fhandler)
-    with open(config_file, mode="r", encoding="utf8") as fhandler:
-        config = json.load(fhandler)
-    with open(odb_config_file, mode="r", encoding="utf8") as fhandler:
-        odb_config = json.load(fhandler)
 
-    obsmon_data = None
-    for base in data:
-        odb_file = f"{datapath}/{base}.{suffix}"
-        print(f"Opening {odb_file}")
-
-        if os.path.exists(odb_file) and os.path.getsize(odb_file) > 0:
-            odb_data = get_odb_data_from_file(odb_file)
-        else:
-            print(f"File {odb_file} is missing or empty")
-            break
-
-        for var in data[base]:
-            varname = config[var]["varname"]
-            obnumber = config[var]["obnumber"]
-            obname = config[var]["obname"]
-            try:
-                satelites = config[var]["satelites"]
-            except KeyError:
-                satelites = ["undefined"]
-            levels = [0]
-            with suppress(KeyError):
-                levels = config[var]["channels"]
-            with suppress(KeyError):
-                levels = config[var]["levels"]
-
-            print(base, varname, obnumber, obname, satelites, levels)
-            for satelite in satelites:
-                for level in levels:
-                    obvar = ODBObsmonVariable(
-                        var, varname, obnumber, obname, base,
-                        satname=satelite, level=level
-                    )
-                    obsmon_data2 = ODBObsmonData(odb_config, obvar).get_view(odb_data)
-                    if obsmon_data is None:
-                        obsmon_data = obsmon_data2
-                    else:
-                        obsmon_data = pd.concat([obsmon_data, obsmon_data2])
-                    obsmon_vars.append(obvar)
+def cmd_args_odb2sqlite_daemon(argv):
+    """Get arguments for command
 
-    if obsmon_data is not None:
-        write_obsmon_sqlite_file(obsmon_data, obsmon_vars, dtg, output_file)
+    Args:
+        argv (list): Input arguments
+
+    Returns:
+       dict: Parser settings
+    """
+
+    parser = argparse.ArgumentParser("odb2sqlite-daemon")
+    parser.add_argument("--run-settings", dest="run_settings", type=str)
+    parser.add_argument("--obsmon-config", dest="obsmon_config", type=str)
+    parser.add_argument("--odb-config", dest="odb_config", type=str)
+    parser.add_argument("--archive", dest="archive", type=str,
+                        help="Archive with YYYY/MM/DD/HH sub-directories")
+    parser.add_argument("--suffix", dest="suffix", type=str)
+    parser.add_argument("--output", dest="output", type=str,
+                        help="Output file. {dtg} is replaced by the cycle")
+    parser.add_argument("--start-dtg", dest="start_dtg", type=str, default=None,
+                        help="First cycle to convert. Default is cycles not complete at start-up")
+    parser.add_argument("--poll-interval", dest="poll_interval", type=float, default=10.0)
+    parser.add_argument("--settle", dest="settle", type=float, default=30.0,
+                        help="Seconds a file must be unmodified to be complete")
+    parser.add_argument("--engine", dest="engine", type=str, default="pandas",
+                        choices=["pandas", "numpy"])
+    parser.add_argument("--concurrent", dest="concurrent", action="store_true", default=False,
+                        help="Stage the rows and publish them to a shared output data base")
+    parser.add_argument("--max-attempts", dest="max_attempts", type=int, default=3,
+                        help="Conversion attempts for a failing cycle")
+    parser.add_argument("--retry-delay", dest="retry_delay", type=float, default=60.0,
+                        help="Seconds before retrying a failed cycle, doubled per attempt")
+    parser.add_argument("--control-socket", dest="control_socket", type=str, default=None)
+    parser.add_argument("--send", dest="send", type=str, default=None,
+                        help="Send a command (convert DTG, status, stop) to a running daemon")
+
+    if len(argv) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args(argv)
+    kwargs = {}
+    for arg in vars(args):
+        kwargs.update({arg: getattr(args, arg)})
+    return kwargs
+
+
+def odb2sqlite_daemon(argv=None):
+    """Run odb2sqlite as a daemon watching an archive.
+
+    Args:
+        argv (list, optional): Input arguments. Default to None
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    kwargs = cmd_args_odb2sqlite_daemon(argv)
+
+    control_socket = kwargs["control_socket"]
+    if kwargs["send"] is not None:
+        if control_socket is None:
+            raise RuntimeError("You need a control socket to send a command")
+        print(send_command(control_socket, kwargs["send"]))
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    run_settings, config, odb_config = read_odb2sqlite_config(
+        kwargs["run_settings"], kwargs["obsmon_config"], kwargs["odb_config"]
+    )
+    daemon = ObsmonDaemon(
+        run_settings,
+        config,
+        odb_config,
+        kwargs["archive"],
+        kwargs["suffix"],
+        kwargs["output"],
+        start_dtg=kwargs["start_dtg"],
+        poll_interval=kwargs["poll_interval"],
+        settle=kwargs["settle"],
+        control_socket=control_socket,
+        engine=kwargs["engine"],
+        concurrent=kwargs["concurrent"],
+        max_attempts=kwargs["max_attempts"],
+        retry_delay=kwargs["retry_delay"],
+    )
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+
+
+def cmd_args_usage2obsmon(argv):
+    """Get arguments for command
+
+    Args:
+        argv (list): Input arguments
+
+    Returns:
+       dict: Parser settings
+    """
+
+    parser = argparse.ArgumentParser("usage2obsmon")
+    parser.add_argument("dbnames", type=str, nargs="+", help="Obsmon data bases")
+    parser.add_argument("--first-dtg", dest="first_dtg", type=str, default=None)
+    parser.add_argument("--last-dtg", dest="last_dtg", type=str, default=None)
+    parser.add_argument("--thinned", dest="thinned", action="store_true", default=False,
+                        help="Replace thinned variables with estimates from the sample")
+
+    if len(argv) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args(argv)
+    kwargs = {}
+    for arg in vars(args):
+        kwargs.update({arg: getattr(args, arg)})
+    return kwargs
+
+
+def usage2obsmon(argv=None):
+    """Recompute the obsmon table from the usage table.
+
+    Args:
+        argv (list, optional): Input arguments. Default to None
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    kwargs = cmd_args_usage2obsmon(argv)
+
+    dtg_range = None
+    if kwargs["first_dtg"] is not None or kwargs["last_dtg"] is not None:
+        first_dtg = kwargs["first_dtg"] if kwargs["first_dtg"] is not None else 0
+        last_dtg = kwargs["last_dtg"] if kwargs["last_dtg"] is not None else 9999999999
+        dtg_range = (first_dtg, last_dtg)
+
+    for dbname in kwargs["dbnames"]:
+        conn = open_db(dbname)
+        create_db(conn, MODES, STAT_COLS)
+        nrows, skipped = usage_to_obsmon(conn, MODES, STAT_COLS, dtg_range=dtg_range,
+                                         thinned=kwargs["thinned"])
+        close_db(conn)
+        print(f"Recomputed {nrows} obsmon rows in {dbname}")
+        if skipped > 0:
+            print(f"Skipped {skipped} thinned obsmon rows in {dbname}. Use --thinned to "
+                  "replace them with estimates")
 
 
 def cmd_args_json2sqlite(argv):
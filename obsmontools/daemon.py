@@ -0,0 +1,336 @@
+"""Daemon mode converting ODB cycles as they land in an archive."""
+import os
+import glob
+import time
+import queue
+import socket
+import logging
+import threading
+import socketserver
+
+from .odb import get_obsmon_data_from_odb_files
+from .obsmon import write_obsmon_sqlite_file
+
+
+def archive_datapath(archive, dtg):
+    """Data path for a cycle in the archive.
+
+    Args:
+        archive (str): Archive root directory.
+        dtg (str): Date time group YYYYMMDDHH.
+
+    Returns:
+        str: Directory archive/YYYY/MM/DD/HH
+
+    """
+    dtg = str(dtg)
+    return f"{archive}/{dtg[0:4]}/{dtg[4:6]}/{dtg[6:8]}/{dtg[8:10]}"
+
+
+class ObsmonDaemon():
+    """Watch an archive and write obsmon data for each new cycle.
+
+    The configuration and the imported libraries are kept in memory between
+    cycles. A cycle is converted when all the ODB bases in the run settings are
+    present and none of them have been modified during the last settle
+    seconds. Cycles with a missing base can be converted on demand with the
+    convert command. A cycle that fails is retried with an exponential backoff
+    and skipped after max_attempts, without blocking newer cycles.
+
+    """
+
+    def __init__(self, run_settings, config, odb_config, archive, suffix, output,
+                 start_dtg=None, poll_interval=10.0, settle=30.0, control_socket=None,
+                 engine="pandas", concurrent=False, max_attempts=3, retry_delay=60.0):
+        """Construct the daemon.
+
+        Args:
+            run_settings (dict): ODB bases and the obsmon variables in each of them.
+            config (dict): Obsmon configuration.
+            odb_config (dict): ODB configuration.
+            archive (str): Archive root directory with YYYY/MM/DD/HH sub-directories.
+            suffix (str): Suffix of the ODB files.
+            output (str): Output file. May contain {dtg}.
+            start_dtg (str, optional): Only convert cycles from this DTG. Defaults to
+                                       None which means cycles complete at start-up
+                                       are skipped.
+            poll_interval (float, optional): Seconds between scans. Defaults to 10.
+            settle (float, optional): Seconds a base must be unmodified before it is
+                                      considered complete. Defaults to 30.
+            control_socket (str, optional): Path to a local control socket.
+                                            Defaults to None.
+            engine (str, optional): "pandas" or "numpy". Defaults to "pandas".
+            concurrent (bool, optional): Stage and publish to a shared output.
+                                         Defaults to False.
+            max_attempts (int, optional): Conversion attempts for a cycle.
+                                          Defaults to 3.
+            retry_delay (float, optional): Seconds before the first retry of a
+                                           failed cycle. Doubled for each attempt.
+                                           Defaults to 60.
+
+        """
+        self.run_settings = run_settings
+        self.config = config
+        self.odb_config = odb_config
+        self.archive = archive
+        self.suffix = suffix
+        self.output = output
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.control_socket = control_socket
+        self.engine = engine
+        self.concurrent = concurrent
+        self.requests = queue.Queue()
+        self.stopped = threading.Event()
+        self.server = None
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.processed = set()
+        self.failed = {}
+        self.start_dtg = start_dtg
+        if start_dtg is None:
+            # Cycles still landing are converted when they are complete
+            now = time.time()
+            self.processed.update(
+                dtg for dtg in self.find_dtgs() if self.is_complete(dtg, now=now)
+            )
+
+    def output_file(self, dtg):
+        """Output file for a cycle.
+
+        Args:
+            dtg (str): Date time group.
+
+        Returns:
+            str: File name.
+
+        """
+        return self.output.format(dtg=dtg)
+
+    def odb_files(self, dtg):
+        """ODB files expected for a cycle.
+
+        Args:
+            dtg (str): Date time group.
+
+        Returns:
+            list: File names.
+
+        """
+        datapath = archive_datapath(self.archive, dtg)
+        return [f"{datapath}/{base}.{self.suffix}" for base in self.run_settings]
+
+    def find_dtgs(self):
+        """Find the cycles present in the archive.
+
+        Returns:
+            list: Sorted date time groups.
+
+        """
+        dtgs = []
+        for path in glob.glob(f"{self.archive}/[0-9]*/[0-9]*/[0-9]*/[0-9]*"):
+            parts = path.split(os.sep)[-4:]
+            dtg = "".join(parts)
+            if os.path.isdir(path) and len(dtg) == 10 and dtg.isdigit():
+                dtgs.append(dtg)
+        return sorted(dtgs)
+
+    def is_complete(self, dtg, now=None):
+        """Check if the ODB files for a cycle are complete.
+
+        Args:
+            dtg (str): Date time group.
+            now (float, optional): Current time. Defaults to None.
+
+        Returns:
+            bool: True if the cycle can be converted.
+
+        """
+        if now is None:
+            now = time.time()
+        for odb_file in self.odb_files(dtg):
+            try:
+                stat = os.stat(odb_file)
+            except FileNotFoundError:
+                return False
+            if stat.st_size == 0 or now - stat.st_mtime < self.settle:
+                return False
+        return True
+
+    def convert(self, dtg):
+        """Convert a cycle.
+
+        Args:
+            dtg (str): Date time group.
+
+        Returns:
+            bool: True if data was written.
+
+        """
+        start = time.time()
+        datapath = archive_datapath(self.archive, dtg)
+        obsmon_data, obsmon_vars = get_obsmon_data_from_odb_files(
+            self.run_settings, self.config, self.odb_config, datapath, self.suffix,
+            engine=self.engine, skip_missing=True
+        )
+        if obsmon_data is None:
+            logging.warning("No obsmon data found for %s", dtg)
+            self.processed.add(dtg)
+            self.failed.pop(dtg, None)
+            return False
+        output_file = self.output_file(dtg)
+        write_obsmon_sqlite_file(
+            obsmon_data, obsmon_vars, dtg, output_file, concurrent=self.concurrent
+        )
+        self.processed.add(dtg)
+        self.failed.pop(dtg, None)
+        logging.info("Wrote %s for %s in %.1f s", output_file, dtg, time.time() - start)
+        return True
+
+    def scan(self):
+        """Convert new and complete cycles in the archive.
+
+        Returns:
+            list: Converted date time groups.
+
+        """
+        converted = []
+        now = time.time()
+        for dtg in self.find_dtgs():
+            if dtg in self.processed:
+                continue
+            if self.start_dtg is not None and dtg < str(self.start_dtg):
+                continue
+            if dtg in self.failed and self.failed[dtg][1] > now:
+                continue
+            if self.is_complete(dtg, now=now):
+                try:
+                    if self.convert(dtg):
+                        converted.append(dtg)
+                except Exception as exc:  # noqa
+                    self.conversion_failed(dtg, exc)
+        return converted
+
+    def conversion_failed(self, dtg, exc):
+        """Record a failed conversion.
+
+        Args:
+            dtg (str): Date time group.
+            exc (Exception): The error.
+
+        """
+        attempts = self.failed.get(dtg, (0, 0.0))[0] + 1
+        if attempts >= self.max_attempts:
+            logging.exception("Conversion of %s failed %s times, skipping: %s", dtg, attempts, exc)
+            self.failed.pop(dtg, None)
+            self.processed.add(dtg)
+            return
+        delay = self.retry_delay * 2**(attempts - 1)
+        logging.exception("Conversion of %s failed, retry in %.0f s: %s", dtg, delay, exc)
+        self.failed[dtg] = (attempts, time.time() + delay)
+
+    def handle_command(self, command):
+        """Handle a control command.
+
+        Commands:
+            convert DTG: Convert (or re-convert) a cycle.
+            status: Number of processed cycles and the last one.
+            stop: Stop the daemon.
+
+        Args:
+            command (str): Command.
+
+        Returns:
+            str: Reply.
+
+        """
+        words = command.split()
+        if len(words) == 0:
+            return "error: empty command"
+        if words[0] == "convert" and len(words) == 2:
+            self.requests.put(words[1])
+            return f"queued {words[1]}"
+        if words[0] == "status":
+            last = max(self.processed) if self.processed else None
+            return f"processed {len(self.processed)} last {last} queued {self.requests.qsize()}"
+        if words[0] == "stop":
+            self.stop()
+            return "stopping"
+        return f"error: unknown command {command}"
+
+    def start_control_server(self):
+        """Start the control socket server in a background thread."""
+        daemon = self
+
+        class ControlHandler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                command = self.rfile.readline().decode("utf8").strip()
+                reply = daemon.handle_command(command)
+                self.wfile.write((reply + "\n").encode("utf8"))
+
+        if os.path.exists(self.control_socket):
+            os.remove(self.control_socket)
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.control_socket, ControlHandler
+        )
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        logging.info("Listening on %s", self.control_socket)
+
+    def stop(self):
+        """Stop the daemon."""
+        self.stopped.set()
+        self.requests.put(None)
+
+    def run(self):
+        """Run until stopped."""
+        if self.control_socket is not None:
+            self.start_control_server()
+        logging.info("Watching %s", self.archive)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.scan()
+                except Exception as exc:  # noqa
+                    logging.exception("Scan failed: %s", exc)
+                try:
+                    dtg = self.requests.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+                if dtg is None:
+                    continue
+                try:
+                    self.convert(dtg)
+                except Exception as exc:  # noqa
+                    logging.exception("Conversion of %s failed: %s", dtg, exc)
+        finally:
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+                os.remove(self.control_socket)
+
+
+def send_command(control_socket, command, timeout=60.0):
+    """Send a command to a running daemon.
+
+    Args:
+        control_socket (str): Path to the control socket.
+        command (str): Command.
+        timeout (float, optional): Timeout in seconds. Defaults to 60.
+
+    Returns:
+        str: Reply from the daemon.
+
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(control_socket)
+        sock.sendall((command + "\n").encode("utf8"))
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    return reply.decode("utf8").strip()
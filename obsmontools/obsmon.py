@@ -1,5 +1,9 @@
 """Obsmon handling."""
+import os
+import time
 import logging
+import pathlib
+import tempfile
 
 import numpy as np
 
@@ -21,13 +25,19 @@ class ObsmonVariable():
         self.level = level
         self.surface = False
         self.passive = False
+        self.bin_widths = None
+        self.thinning = None
 
 
-def open_db(dbname):
+def open_db(dbname, readonly=False, timeout=5.0, wal=False):
     """Open database.
 
     Args:
         dbname (str): File name.
+        readonly (bool, optional): Open the data base read-only. Defaults to False.
+        timeout (float, optional): Seconds to wait for a locked data base.
+                                   Defaults to 5.
+        wal (bool, optional): Use write-ahead logging. Defaults to False.
 
     Raises:
         RuntimeError: Need SQLite
@@ -39,7 +49,13 @@ def open_db(dbname):
     if sqlite3 is None:
         raise RuntimeError("You need SQLITE for obsmon")
 
-    conn = sqlite3.connect(dbname)
+    if readonly:
+        uri = pathlib.Path(dbname).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=timeout)
+    else:
+        conn = sqlite3.connect(dbname, timeout=timeout)
+    if wal:
+        conn.execute("PRAGMA journal_mode=WAL")
     return conn
 
 
@@ -68,10 +84,30 @@ def create_db(conn, modes, stat_cols):
         "CREATE TABLE IF NOT EXISTS usage (DTG INT, obnumber INT, obname CHAR(20), "
         "satname CHAR(20), varname CHAR(20), level INT, latitude FLOAT, longitude FLOAT, "
         "statid CHAR(20), obsvalue FLOAT, fg_dep FLOAT, an_dep FLOAT, biascrl FLOAT, "
-        "active INT, rejected INT, passive INT, blacklisted INT, anflag INT)"
+        "active INT, rejected INT, passive INT, blacklisted INT, anflag INT, laf FLOAT, "
+        "weight FLOAT)"
     )
 
     cursor.execute(cmd)
+    # Land fraction and sampling weight were added later. Concurrent writers
+    # may migrate the same file, so the columns are checked again after
+    # taking the write lock.
+    migrate = ["laf", "weight"]
+    usage_cols = [row[1] for row in cursor.execute("PRAGMA table_info(usage)").fetchall()]
+    if any(col not in usage_cols for col in migrate):
+        conn.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            usage_cols = [
+                row[1] for row in cursor.execute("PRAGMA table_info(usage)").fetchall()
+            ]
+            for col in migrate:
+                if col not in usage_cols:
+                    cursor.execute("ALTER TABLE usage ADD COLUMN " + col + " FLOAT")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
 
     # Create obsmon table
     cmd = (
@@ -88,107 +124,556 @@ def create_db(conn, modes, stat_cols):
     cursor.execute(
         """CREATE INDEX IF NOT EXISTS obsmon_index on usage(DTG,obnumber,obname)"""
     )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS obsmon_dtg_index on obsmon(DTG,obname,varname)"""
+    )
+
+    # Create station statistics tables per DTG and per period (YYYYMM)
+    for table, time_col in [("station_stats", "DTG INT"), ("station_stats_period", "period INT")]:
+        cmd = (
+            "CREATE TABLE IF NOT EXISTS " + table + " (" + time_col + ", statid CHAR(20), "
+            "obnumber INT, obname CHAR(20), varname CHAR(20), level INT"
+        )
+        for col in STATION_STAT_COLS:
+            cmd = cmd + "," + col + (" FLOAT" if col.endswith("sum") else " INT")
+        cmd = cmd + ")"
+        cursor.execute(cmd)
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS " + table + "_key on " + table + "("
+            + time_col.split()[0] + ",statid,obnumber,obname,varname,level)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS " + table + "_station on " + table
+            + "(statid,obnumber,varname,level)"
+        )
+
+    # Create histogram table
+    cmd = (
+        "CREATE TABLE IF NOT EXISTS histogram (DTG INT, obnumber INT, obname CHAR(20), "
+        "satname CHAR(20), varname CHAR(20), level INT, mode CHAR(10), quantity CHAR(10), "
+        "bin_width FLOAT, bin INT, count INT)"
+    )
+    cursor.execute(cmd)
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS histogram_index on histogram(DTG,obname,varname)"""
+    )
 
     # Save (commit) the changes
     conn.commit()
 
 
-def populate_usage_db(conn, dtg, observations):
+USAGE_STATUS = {
+    1: (1, 0, 0, 0),  # Active
+    3: (1, 0, 1, 0),  # Active + passive
+    4: (0, 0, 0, 1),  # Rejected
+    5: (0, 0, 1, 0),  # Passive
+    6: (0, 0, 1, 1),  # Passive and rejected
+    12: (0, 1, 0, 1),  # Blacklisted and rejected
+    14: (0, 1, 1, 1),  # Blacklisted, passive and rejected
+}
+
+
+def usage_status(flags):
+    """Usage status columns from ODB datum status.
+
+    Args:
+        flags (np.ndarray): Datum status.
+
+    Raises:
+        NotImplementedError: Unknown status
+
+    Returns:
+        np.ndarray: Active, blacklisted, passive and rejected columns (nobs, 4).
+
+    """
+    flags = np.asarray(flags).astype(int)
+    unknown = ~np.isin(flags, list(USAGE_STATUS))
+    if unknown.any():
+        status = int(flags[unknown][0])
+        raise NotImplementedError(f"Unknown datum status {status}")
+    codes = np.array(list(USAGE_STATUS))
+    table = np.array(list(USAGE_STATUS.values()), dtype=int)
+    return table[np.searchsorted(codes, flags)]
+
+
+def spatial_hash(lat, lon):
+    """Deterministic pseudo-random key from the position.
+
+    Args:
+        lat (np.ndarray): Latitudes.
+        lon (np.ndarray): Longitudes.
+
+    Returns:
+        np.ndarray: Keys (uint64).
+
+    """
+    key = np.round(np.asarray(lat, dtype=float) * 1e5).astype(np.int64).astype(np.uint64)
+    key = key * np.uint64(0x9E3779B97F4A7C15)
+    key ^= np.round(np.asarray(lon, dtype=float) * 1e5).astype(np.int64).astype(np.uint64)
+    key ^= key >> np.uint64(31)
+    key *= np.uint64(0xBF58476D1CE4E5B9)
+    key ^= key >> np.uint64(29)
+    return key
+
+
+def thinning_weights(observations, obsmon_variables):
+    """Sampling weights of the observations stored in usage.
+
+    Rejected, blacklisted and passive observations are always kept. For
+    obsmon variables with a thinning policy, at most max_per_cell of the
+    active observations are kept in each grid cell of grid degrees, chosen
+    deterministically from the position. A kept observation represents
+    weight observations and removed observations get weight 0.
+
+    Args:
+        observations (pd.DataFrame|dict): Observation columns.
+        obsmon_variables (list): Obsmon variables.
+
+    Returns:
+        np.ndarray: Weights.
+
+    """
+    nobs = len(observations["value"])
+    weight = np.ones(nobs)
+    policies = [
+        obsmon_variable for obsmon_variable in obsmon_variables
+        if obsmon_variable.thinning is not None
+    ]
+    if len(policies) == 0 or nobs == 0:
+        return weight
+
+    status = usage_status(observations["flag"])
+    active = (status[:, 0] == 1) & (status[:, 1:].sum(axis=1) == 0)
+    obnumber = np.asarray(observations["obnumber"]).astype(int)
+    obname = np.asarray(observations["obname"]).astype(str)
+    satname = np.asarray(observations["satname"]).astype(str)
+    varname = np.asarray(observations["varname"]).astype(str)
+    level = np.asarray(observations["level"]).astype(int)
+    lat = np.asarray(observations["lat"], dtype=float)
+    lon = np.asarray(observations["lon"], dtype=float)
+
+    for obsmon_variable in policies:
+        rows = np.flatnonzero(
+            active &
+            (obnumber == int(obsmon_variable.obnumber)) &
+            (obname == obsmon_variable.obname) &
+            (satname == obsmon_variable.satname) &
+            (varname == obsmon_variable.varname) &
+            (level == int(obsmon_variable.level))
+        )
+        if len(rows) == 0:
+            continue
+        grid = float(obsmon_variable.thinning["grid"])
+        max_per_cell = int(obsmon_variable.thinning.get("max_per_cell", 1))
+        _, cell = group_rows(np.floor(lat[rows] / grid), np.floor(lon[rows] / grid))
+        order = np.lexsort((spatial_hash(lat[rows], lon[rows]), cell))
+        ncell = np.bincount(cell)
+        start = np.concatenate([[0], np.cumsum(ncell)[:-1]])
+        rank = np.empty(len(rows), dtype=int)
+        rank[order] = np.arange(len(rows)) - start[cell[order]]
+        kept = np.minimum(ncell, max_per_cell)
+        weight[rows] = np.where(rank < max_per_cell, ncell[cell] / kept[cell], 0.0)
+    return weight
+
+
+def populate_usage_db(conn, dtg, observations, obsmon_variables=None):
     """Populate usage.
 
+    The observations can be a pandas DataFrame or a dict of numpy arrays.
+    Active observations are thinned according to the thinning policy of the
+    obsmon variables and the sampling weight is stored. Existing rows for the
+    DTG and the obsmon variables are replaced.
+
     Args:
-        conn (_type_): _description_
-        dtg (_type_): _description_
-        varname (_type_): _description_
-        observations (_type_): _description_
+        conn (sqlite3.connect): Data base connection.
+        dtg (str): Date time group.
+        observations (pd.DataFrame|dict): Observation columns.
+        obsmon_variables (list, optional): Obsmon variables. Defaults to None.
 
     """
     logging.info("Update usage")
 
+    if obsmon_variables is None:
+        obsmon_variables = []
+    weight = thinning_weights(observations, obsmon_variables)
+    keep = weight > 0
+    value = np.asarray(observations["value"], dtype=float)[keep]
+    missing = np.isnan(value)
+    fg_dep = np.asarray(observations["fg_dep"], dtype=float)[keep]
+    an_dep = np.asarray(observations["an_dep"], dtype=float)[keep]
+    status = usage_status(observations["flag"])[keep]
+    nobs = len(value)
+    logging.info("Store %s of %s observations", nobs, len(keep))
+
+    def nullable(values, null):
+        values = values.astype(object)
+        values[null] = None
+        return values.tolist()
+
+    def column(name, dtype=None):
+        return np.asarray(observations[name], dtype=dtype)[keep]
+
+    rows = zip(
+        [int(dtg)] * nobs,
+        column("obnumber").astype(int).tolist(),
+        column("obname").astype(str).tolist(),
+        column("satname").astype(str).tolist(),
+        column("varname").astype(str).tolist(),
+        column("level").astype(int).tolist(),
+        np.round(column("lat", dtype=float), 5).tolist(),
+        np.round(column("lon", dtype=float), 5).tolist(),
+        column("stid").astype(str).tolist(),
+        nullable(value, missing),
+        nullable(fg_dep, missing | np.isnan(fg_dep)),
+        nullable(an_dep, missing | np.isnan(an_dep)),
+        column("biascrl", dtype=float).tolist(),
+        status[:, 0].tolist(),
+        status[:, 1].tolist(),
+        status[:, 2].tolist(),
+        status[:, 3].tolist(),
+        column("anflag").astype(int).tolist(),
+        column("laf", dtype=float).tolist(),
+        weight[keep].tolist(),
+    )
     cursor = conn.cursor()
-    # Insert a row of data
-    for index, row in observations.iterrows():
-        varname = row["varname"]
-        obname = row["obname"]
-        obnumber = str(row["obnumber"])
-        satname = row["satname"]
-        level = str(row["level"])
-        lon = f"{float(row['lon']):10.5f}"
-        lat = f"{float(row['lat']):10.5f}"
-        stid = str(row['stid'])
-        value = str(row['value'])
-        biascrl = str(row['biascrl'])
-        anflag = str(row['anflag'])
-        if value == "nan":
-            value = "NULL"
-        if value == "NULL":
-            fg_dep = "NULL"
-            an_dep = "NULL"
-        else:
-            fg_dep = "NULL" if np.isnan(row['fg_dep']) else str(row['fg_dep'])
-            an_dep = "NULL" if np.isnan(row['an_dep']) else str(row['an_dep'])
-
-        status = int(row['flag'])
-        if status == 1: # Active
-            istatus = "1,0,0,0"
-        elif status == 3: # Active + passive
-            istatus = "1,0,1,0"
-        elif status == 4: # Rejected
-            istatus = "0,0,0,1"
-        elif status == 5: # Passive
-            istatus = "0,0,1,0"
-        elif status == 6: # Passive and rejected
-            istatus = "0,0,1,1"
-        elif status == 12: # Blacklisted and rejected
-            istatus = "0,1,0,1"
-        elif status == 14: # Blacklisted, passive and rejected
-            istatus = "0,1,1,1"
-        else:
-            print(status)
-            raise NotImplementedError(status)
-        
-        cmd = (
-            "INSERT INTO usage VALUES("
-            + str(dtg)
-            + ","
-            + obnumber
-            + ',"'
-            + obname
-            + '","'
-            + satname
-            + '","'
-            + varname
-            + '",'
-            + level
-            + ","
-            + lat
-            + ","
-            + lon
-            + ',"'
-            + stid
-            + '",'
-            + value
-            + ","
-            + fg_dep
-            + ","
-            + an_dep
-            + ","
-            + biascrl
-            + ","
-            + istatus
-            + ","
-            + anflag
-            + ")"
+    # Replace the rows of a rewritten DTG
+    for obsmon_variable in obsmon_variables:
+        cursor.execute(
+            "DELETE FROM usage WHERE DTG == ? AND obnumber == ? AND obname == ? "
+            "AND satname == ? AND varname == ? AND level == ?",
+            (int(dtg), obsmon_variable.obnumber, obsmon_variable.obname,
+             obsmon_variable.satname, obsmon_variable.varname, obsmon_variable.level)
         )
-        #print(cmd)
-        logging.info(cmd)
-        cursor.execute(cmd)
+    cursor.executemany(
+        "INSERT INTO usage VALUES(" + ",".join(["?"] * 20) + ")", rows
+    )
 
     # Save (commit) the changes
     conn.commit()
     logging.info("Updated usage")
 
 
+STATION_STAT_COLS = [
+    "nobs",
+    "nactive",
+    "npassive",
+    "nrejected",
+    "nblacklisted",
+    "n_fg_dep",
+    "fg_dep_sum",
+    "fg_dep_sq_sum",
+    "n_an_dep",
+    "an_dep_sum",
+    "an_dep_sq_sum",
+    "biascrl_sum",
+]
+
+
+def group_rows(*keys):
+    """Group rows by key columns.
+
+    Args:
+        keys (np.ndarray): Key columns.
+
+    Returns:
+        tuple: Index of the first row in each group and group index of each row.
+
+    """
+    codes = np.column_stack([
+        np.unique(np.asarray(key).astype(str), return_inverse=True)[1].ravel()
+        for key in keys
+    ])
+    _, first, inverse = np.unique(codes, axis=0, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
+
+
+def station_statistics(observations):
+    """Mergeable per station statistics.
+
+    Args:
+        observations (pd.DataFrame|dict): Observation columns.
+
+    Returns:
+        tuple: Key columns (statid, obnumber, obname, varname, level) and a dict
+               with the STATION_STAT_COLS for each station.
+
+    """
+    statid = np.asarray(observations["stid"]).astype(str)
+    obnumber = np.asarray(observations["obnumber"]).astype(int)
+    obname = np.asarray(observations["obname"]).astype(str)
+    varname = np.asarray(observations["varname"]).astype(str)
+    level = np.asarray(observations["level"]).astype(int)
+    if len(statid) == 0:
+        return [], {col: np.array([]) for col in STATION_STAT_COLS}
+
+    first, group = group_rows(statid, obnumber, obname, varname, level)
+    ngroups = len(first)
+
+    value = np.asarray(observations["value"], dtype=float)
+    fg_dep = np.asarray(observations["fg_dep"], dtype=float)
+    an_dep = np.asarray(observations["an_dep"], dtype=float)
+    fg_dep = np.where(np.isnan(value), np.nan, fg_dep)
+    an_dep = np.where(np.isnan(value), np.nan, an_dep)
+    fg_ok = ~np.isnan(fg_dep)
+    an_ok = ~np.isnan(an_dep)
+    fg_dep = np.where(fg_ok, fg_dep, 0.0)
+    an_dep = np.where(an_ok, an_dep, 0.0)
+    status = usage_status(observations["flag"])
+
+    def total(weights):
+        return np.bincount(group, weights=weights, minlength=ngroups)
+
+    stats = {
+        "nobs": np.bincount(group, minlength=ngroups),
+        "nactive": total(status[:, 0]).astype(int),
+        "npassive": total(status[:, 2]).astype(int),
+        "nrejected": total(status[:, 3]).astype(int),
+        "nblacklisted": total(status[:, 1]).astype(int),
+        "n_fg_dep": total(fg_ok).astype(int),
+        "fg_dep_sum": total(fg_dep),
+        "fg_dep_sq_sum": total(fg_dep ** 2),
+        "n_an_dep": total(an_ok).astype(int),
+        "an_dep_sum": total(an_dep),
+        "an_dep_sq_sum": total(an_dep ** 2),
+        "biascrl_sum": total(np.asarray(observations["biascrl"], dtype=float)),
+    }
+    keys = [statid[first], obnumber[first], obname[first], varname[first], level[first]]
+    return keys, stats
+
+
+def station_keys(obsmon_variables):
+    """Station statistics keys written for obsmon variables.
+
+    Args:
+        obsmon_variables (list): Obsmon variables.
+
+    Returns:
+        list: Unique (obnumber, obname, varname, level).
+
+    """
+    keys = []
+    for obsmon_variable in obsmon_variables:
+        key = (
+            int(obsmon_variable.obnumber), obsmon_variable.obname,
+            obsmon_variable.varname, int(obsmon_variable.level)
+        )
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def merge_station_stats(cursor, dtg, source, keys):
+    """Replace the station statistics for a DTG with the rows in source.
+
+    The previous contribution of the replaced rows is removed from the period
+    (YYYYMM) sums before the new rows are added.
+
+    Args:
+        cursor (sqlite3.Cursor): Data base cursor.
+        dtg (str): Date time group.
+        source (str): Table with new station_stats rows.
+        keys (list): Replaced (obnumber, obname, varname, level).
+
+    """
+    dtg = int(dtg)
+    period = dtg // 10000
+    key_cols = "statid,obnumber,obname,varname,level"
+    stat_cols = ",".join(STATION_STAT_COLS)
+    merge = ",".join([col + "=" + col + "+excluded." + col for col in STATION_STAT_COLS])
+    where = " WHERE DTG == ? AND obnumber == ? AND obname == ? AND varname == ? AND level == ?"
+
+    for key in keys:
+        # Remove the previous contribution of this DTG from the period
+        cursor.execute(
+            "INSERT INTO main.station_stats_period (period," + key_cols + "," + stat_cols + ") "
+            "SELECT ?," + key_cols + "," + ",".join(["-" + col for col in STATION_STAT_COLS])
+            + " FROM main.station_stats" + where + " "
+            "ON CONFLICT(period," + key_cols + ") DO UPDATE SET " + merge,
+            (period, dtg) + tuple(key),
+        )
+        cursor.execute("DELETE FROM main.station_stats" + where, (dtg,) + tuple(key))
+
+    cursor.execute(
+        "INSERT INTO main.station_stats (DTG," + key_cols + "," + stat_cols + ") "
+        "SELECT DTG," + key_cols + "," + stat_cols + " FROM " + source + " WHERE DTG == ?",
+        (dtg,),
+    )
+    cursor.execute(
+        "INSERT INTO main.station_stats_period (period," + key_cols + "," + stat_cols + ") "
+        "SELECT ?," + key_cols + "," + stat_cols + " FROM " + source + " WHERE DTG == ? "
+        "ON CONFLICT(period," + key_cols + ") DO UPDATE SET " + merge,
+        (period, dtg),
+    )
+    # Only the period rows of the replaced keys can have dropped to zero
+    for key in keys:
+        cursor.execute(
+            "DELETE FROM main.station_stats_period WHERE period == ? AND obnumber == ? "
+            "AND obname == ? AND varname == ? AND level == ? AND nobs == 0",
+            (period,) + tuple(key),
+        )
+
+
+def populate_station_db(conn, dtg, observations, obsmon_variables):
+    """Update the station statistics incrementally.
+
+    The rows for the DTG and the obsmon variables are replaced and the period
+    (YYYYMM) sums are updated by removing the old and adding the new DTG
+    contributions.
+
+    Args:
+        conn (sqlite3.connect): Data base connection.
+        dtg (str): Date time group.
+        observations (pd.DataFrame|dict): Observation columns.
+        obsmon_variables (list): Obsmon variables.
+
+    """
+    logging.info("Update station statistics")
+
+    keys, stats = station_statistics(observations)
+    rows = list(zip(
+        *[key.tolist() for key in keys],
+        *[stats[col].tolist() for col in STATION_STAT_COLS]
+    ))
+
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS station_stats_new AS "
+        "SELECT * FROM main.station_stats WHERE 0"
+    )
+    cursor.execute("DELETE FROM temp.station_stats_new")
+    cursor.executemany(
+        "INSERT INTO temp.station_stats_new (DTG,statid,obnumber,obname,varname,level,"
+        + ",".join(STATION_STAT_COLS) + ") "
+        "VALUES(" + str(int(dtg)) + "," + ",".join(["?"] * (5 + len(STATION_STAT_COLS))) + ")",
+        rows,
+    )
+    merge_station_stats(cursor, dtg, "temp.station_stats_new", station_keys(obsmon_variables))
+    cursor.execute("DELETE FROM temp.station_stats_new")
+
+    # Save (commit) the changes
+    conn.commit()
+    logging.info("Updated station statistics")
+
+
+# Suits variables in K and m/s. Variables in other units set
+# histogram_bin_widths in the obsmon config.
+HISTOGRAM_BIN_WIDTHS = {
+    "fg_dep": 0.1,
+    "an_dep": 0.1,
+    "obsvalue": 1.0,
+}
+
+
+def histograms(observations, modes, obsmon_variables):
+    """Fixed bin histograms of departures and observed values.
+
+    Bin i covers [i * bin_width, (i + 1) * bin_width). Only bins with
+    observations are returned, so histograms from different cycles can be
+    added by bin.
+
+    Args:
+        observations (pd.DataFrame|dict): Observation columns.
+        modes (list): Modes (total, land, sea).
+        obsmon_variables (list): Obsmon variables. Their bin_widths override
+                                 HISTOGRAM_BIN_WIDTHS.
+
+    Returns:
+        list: Rows (obnumber, obname, satname, varname, level, mode, quantity,
+              bin_width, bin, count).
+
+    """
+    obnumber = np.asarray(observations["obnumber"]).astype(int)
+    obname = np.asarray(observations["obname"]).astype(str)
+    satname = np.asarray(observations["satname"]).astype(str)
+    varname = np.asarray(observations["varname"]).astype(str)
+    level = np.asarray(observations["level"]).astype(int)
+    if len(obnumber) == 0:
+        return []
+    first, variable = group_rows(obnumber, obname, satname, varname, level)
+
+    laf = np.asarray(observations["laf"], dtype=float)
+    value = np.asarray(observations["value"], dtype=float)
+    missing = np.isnan(value)
+    quantities = {
+        "fg_dep": np.where(missing, np.nan, np.asarray(observations["fg_dep"], dtype=float)),
+        "an_dep": np.where(missing, np.nan, np.asarray(observations["an_dep"], dtype=float)),
+        "obsvalue": value,
+    }
+
+    bin_widths = {}
+    for obsmon_variable in obsmon_variables:
+        key = (
+            int(obsmon_variable.obnumber), obsmon_variable.obname, obsmon_variable.satname,
+            obsmon_variable.varname, int(obsmon_variable.level)
+        )
+        bin_widths[key] = dict(HISTOGRAM_BIN_WIDTHS)
+        if obsmon_variable.bin_widths is not None:
+            bin_widths[key].update(obsmon_variable.bin_widths)
+
+    rows = []
+    for quantity, values in quantities.items():
+        widths = np.array([
+            bin_widths.get(
+                (obnumber[index], obname[index], satname[index], varname[index], level[index]),
+                HISTOGRAM_BIN_WIDTHS
+            )[quantity]
+            for index in first
+        ], dtype=float)
+        row_widths = widths[variable]
+        bins = np.floor(values / row_widths)
+        for mode in modes:
+            subset = ~np.isnan(values)
+            if mode == "land":
+                subset &= laf == float(1)
+            elif mode == "sea":
+                subset &= laf == float(0)
+            if not subset.any():
+                continue
+            keys, counts = np.unique(
+                np.column_stack([variable[subset], bins[subset].astype(np.int64)]),
+                axis=0, return_counts=True
+            )
+            for (ivar, ibin), count in zip(keys.tolist(), counts.tolist()):
+                index = first[ivar]
+                rows.append((
+                    int(obnumber[index]), str(obname[index]), str(satname[index]),
+                    str(varname[index]), int(level[index]), mode, quantity,
+                    float(widths[ivar]), ibin, count
+                ))
+    return rows
+
+
+def populate_histogram_db(conn, dtg, observations, modes, obsmon_variables):
+    """Populate histogram.
+
+    Args:
+        conn (sqlite3.connect): Data base connection.
+        dtg (str): Date time group.
+        observations (pd.DataFrame|dict): Observation columns.
+        modes (list): Modes (total, land, sea).
+        obsmon_variables (list): Obsmon variables.
+
+    """
+    logging.info("Update histogram table")
+
+    cursor = conn.cursor()
+    for obsmon_variable in obsmon_variables:
+        cursor.execute(
+            "DELETE FROM histogram WHERE DTG == ? AND obnumber == ? AND obname == ? "
+            "AND satname == ? AND varname == ? AND level == ?",
+            (int(dtg), obsmon_variable.obnumber, obsmon_variable.obname,
+             obsmon_variable.satname, obsmon_variable.varname, obsmon_variable.level)
+        )
+    cursor.executemany(
+        "INSERT INTO histogram VALUES(" + str(int(dtg)) + "," + ",".join(["?"] * 10) + ")",
+        histograms(observations, modes, obsmon_variables)
+    )
+
+    # Save (commit) the changes
+    conn.commit()
+    logging.info("Updated histogram table")
+
+
 def rmse(predictions, targets):
     """Root mean square error.
 
@@ -251,19 +736,24 @@ def calculate_statistics(observations, modes, stat_cols):
 
     """
 
+    laf = np.asarray(observations["laf"], dtype=float)
+    values = np.asarray(observations["value"], dtype=float)
+    fg_deps = np.asarray(observations["fg_dep"], dtype=float)
+    an_deps = np.asarray(observations["an_dep"], dtype=float)
+
     statistics = {}
     for mode in modes:
 
         if mode == "total":
-            subset = observations
+            subset = np.ones(len(laf), dtype=bool)
         if mode == "land":
-            subset = observations[observations["laf"] == float(1)]
+            subset = laf == float(1)
         elif mode == "sea":
-            subset = observations[observations["laf"] == float(0)]
+            subset = laf == float(0)
 
-        obs = subset["value"].to_numpy()
-        fg_dep = subset["fg_dep"].to_numpy()
-        an_dep = subset["an_dep"].to_numpy()
+        obs = values[subset]
+        fg_dep = fg_deps[subset]
+        an_dep = an_deps[subset]
 
         for col in stat_cols:
             tab = col + "_" + mode
@@ -346,13 +836,16 @@ def populate_obsmon_db(conn, dtg, data, modes, stat_cols, obsmon_variables):
         #print(varname, obnumber, obname, satname, level)
         #print(len(data), data[["obnumber", "obname", "varname", "satname", "level"]])
 
-        obdata = data[
-            (data["obnumber"] == obnumber) &
-            (data["obname"] == obname) &
-            (data["varname"] == varname) &
-            (data["satname"] == satname) &
-            (data["level"] == level)
-        ]
+        selection = (
+            (np.asarray(data["obnumber"]) == obnumber) &
+            (np.asarray(data["obname"]) == obname) &
+            (np.asarray(data["varname"]) == varname) &
+            (np.asarray(data["satname"]) == satname) &
+            (np.asarray(data["level"]) == level)
+        )
+        obdata = {
+            col: np.asarray(data[col])[selection] for col in ["laf", "value", "fg_dep", "an_dep"]
+        }
         #print(len(obdata), obdata[["obnumber", "obname", "varname"]])
         statistics = calculate_statistics(obdata, modes, stat_cols)
         cursor = conn.cursor()
@@ -433,27 +926,347 @@ def populate_obsmon_db(conn, dtg, data, modes, stat_cols, obsmon_variables):
         conn.commit()
 
 
-def write_obsmon_sqlite_file(obsmon_data, obsmon_variables, dtg, dbname):
-    """Write obsmon sqlite file."""
-
-    modes = ["total", "land", "sea"]
-    stat_cols = [
-        "nobs",
-        "fg_bias",
-        "fg_abs_bias",
-        "fg_rms",
-        "fg_dep",
-        "fg_uncorr",
-        "bc",
-        "an_bias",
-        "an_abs_bias",
-        "an_rms",
-        "an_dep",
-    ]
+MODES = ["total", "land", "sea"]
+STAT_COLS = [
+    "nobs",
+    "fg_bias",
+    "fg_abs_bias",
+    "fg_rms",
+    "fg_dep",
+    "fg_uncorr",
+    "bc",
+    "an_bias",
+    "an_abs_bias",
+    "an_rms",
+    "an_dep",
+]
+
+
+def aggregate_usage(conn, modes, dtg_range=None, thinned=False):
+    """Aggregate the usage table per DTG and obsmon variable in SQL.
+
+    Rows are weighted with their sampling weight. The sums are exact for
+    variables without thinning and only estimates for thinned variables, so
+    thinned variables are skipped unless requested.
+
+    Args:
+        conn (sqlite3.connect): Data base connection.
+        modes (list): Modes (total, land, sea).
+        dtg_range (tuple, optional): First and last DTG. Defaults to None (all).
+        thinned (bool, optional): Include thinned variables. Defaults to False.
+
+    Raises:
+        NotImplementedError: Unknown mode
+
+    Returns:
+        tuple: Key rows (DTG, obnumber, obname, satname, varname, level) and a
+               dict with sums for each mode and the number of rows without laf.
+
+    """
+    conditions = {"total": "1", "land": "laf == 1.0", "sea": "laf == 0.0"}
+    weight = "COALESCE(weight, 1.0)"
+    aggregates = []
+    names = []
+    for mode in modes:
+        if mode not in conditions:
+            raise NotImplementedError(mode)
+        cond = conditions[mode]
+        rms = f"{cond} AND obsvalue IS NOT NULL"
+        for dep in ["fg_dep", "an_dep"]:
+            aggregates += [
+                f"TOTAL(CASE WHEN {cond} AND {dep} IS NOT NULL THEN {weight} END)",
+                f"TOTAL(CASE WHEN {cond} THEN {weight} * {dep} END)",
+                f"TOTAL(CASE WHEN {cond} THEN {weight} * ABS({dep}) END)",
+                f"TOTAL(CASE WHEN {rms} AND {dep} IS NOT NULL THEN {weight} END)",
+                f"TOTAL(CASE WHEN {rms} THEN {weight} * {dep} * {dep} END)",
+            ]
+            names += [
+                (mode, dep, "n"), (mode, dep, "sum"), (mode, dep, "abs_sum"),
+                (mode, dep, "n_rms"), (mode, dep, "sq_sum"),
+            ]
+        aggregates.append(f"TOTAL(CASE WHEN {cond} THEN {weight} END)")
+        names.append((mode, "nobs", "n"))
+    # Usage written before the land fraction was stored has laf NULL
+    aggregates.append("COUNT(*) - COUNT(laf)")
+    names.append(("total", "laf", "missing"))
+
+    keys = "DTG, obnumber, obname, satname, varname, level"
+    cmd = "SELECT " + keys + ", " + ", ".join(aggregates) + " FROM usage"
+    params = []
+    if dtg_range is not None:
+        cmd = cmd + " WHERE DTG BETWEEN ? AND ?"
+        params = [int(dtg_range[0]), int(dtg_range[1])]
+    cmd = cmd + " GROUP BY " + keys
+    if not thinned:
+        cmd = cmd + " HAVING MAX(" + weight + ") == 1.0"
+    logging.info(cmd)
+    rows = conn.execute(cmd, params).fetchall()
+    if len(rows) == 0:
+        return [], {}
+    values = np.array([row[6:] for row in rows], dtype=float)
+    sums = {name: values[:, icol] for icol, name in enumerate(names)}
+    return [row[:6] for row in rows], sums
+
+
+def statistics_from_sums(sums, modes, stat_cols):
+    """Obsmon statistics from aggregated usage sums.
+
+    Matches calculate_statistics for the observations stored in usage. Note
+    that usage does not store departures for missing observed values.
+
+    Args:
+        sums (dict): Sums from aggregate_usage.
+        modes (list): Modes (total, land, sea).
+        stat_cols (list): Statistics.
+
+    Raises:
+        NotImplementedError: Unknown statistic
+
+    Returns:
+        dict: Statistic columns as arrays. NaN means undefined.
+
+    """
+    def ratio(numerator, denominator):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denominator > 0, numerator / denominator, np.nan)
+
+    statistics = {}
+    for mode in modes:
+        nobs = sums[(mode, "nobs", "n")]
+        columns = {"nobs": nobs, "bc": np.zeros(len(nobs))}
+        for dep, prefix in [("fg_dep", "fg"), ("an_dep", "an")]:
+            bias = ratio(sums[(mode, dep, "sum")], sums[(mode, dep, "n")])
+            columns.update({
+                prefix + "_bias": bias,
+                prefix + "_abs_bias": ratio(sums[(mode, dep, "abs_sum")], sums[(mode, dep, "n")]),
+                prefix + "_rms": np.sqrt(ratio(sums[(mode, dep, "sq_sum")],
+                                               sums[(mode, dep, "n_rms")])),
+                prefix + "_dep": bias,
+            })
+        columns["fg_uncorr"] = columns["fg_bias"]
+        for col in stat_cols:
+            if col not in columns:
+                raise NotImplementedError("Not defined " + col)
+            # Empty subsets are stored as 0 by calculate_statistics
+            statistics[col + "_" + mode] = np.where(nobs > 0, columns[col], 0)
+    return statistics
+
+
+def count_thinned_usage(conn, dtg_range=None):
+    """Count the DTG and obsmon variable groups in usage that are thinned.
+
+    Args:
+        conn (sqlite3.connect): Data base connection.
+        dtg_range (tuple, optional): First and last DTG. Defaults to None (all).
+
+    Returns:
+        int: Number of thinned groups.
+
+    """
+    keys = "DTG, obnumber, obname, satname, varname, level"
+    cmd = "SELECT COUNT(*) FROM (SELECT 1 FROM usage"
+    params = []
+    if dtg_range is not None:
+        cmd = cmd + " WHERE DTG BETWEEN ? AND ?"
+        params = [int(dtg_range[0]), int(dtg_range[1])]
+    cmd = cmd + " GROUP BY " + keys + " HAVING MAX(COALESCE(weight, 1.0)) != 1.0)"
+    logging.info(cmd)
+    return conn.execute(cmd, params).fetchone()[0]
+
+
+def usage_to_obsmon(conn, modes, stat_cols, dtg_range=None, thinned=False):
+    """Recompute the obsmon table from the usage table.
+
+    Rows are updated for each DTG and obsmon variable in usage, and inserted
+    if missing. Obsmon rows without usage are left untouched.
+
+    Thinned variables only have a sample of the active observations in usage.
+    Their obsmon rows were computed from all observations, so they are
+    skipped by default. With thinned=True they are replaced with estimates
+    from the weighted sample.
+
+    Usage written before the land fraction was stored can not be split in
+    land and sea. For these rows only the total columns are updated, and the
+    land and sea columns are NULL if the obsmon row is inserted.
+
+    Args:
+        conn (sqlite3.connect): Data base connection.
+        modes (list): Modes (total, land, sea).
+        stat_cols (list): Statistics.
+        dtg_range (tuple, optional): First and last DTG. Defaults to None (all).
+        thinned (bool, optional): Recompute thinned variables. Defaults to False.
+
+    Returns:
+        tuple: Number of obsmon rows written and number of thinned rows skipped.
+
+    """
+    logging.info("Recompute obsmon table from usage")
+
+    skipped = 0
+    if not thinned:
+        skipped = count_thinned_usage(conn, dtg_range=dtg_range)
+        if skipped > 0:
+            logging.warning("Skipping %s thinned obsmon rows", skipped)
+    keys, sums = aggregate_usage(conn, modes, dtg_range=dtg_range, thinned=thinned)
+    if len(keys) == 0:
+        return 0, skipped
+    statistics = statistics_from_sums(sums, modes, stat_cols)
+    tabs = [col + "_" + mode for mode in modes for col in stat_cols]
+
+    def nullable(value):
+        return None if np.isnan(value) else value
+
+    columns = [[nullable(value) for value in statistics[tab].tolist()] for tab in tabs]
+    where = (
+        " WHERE DTG == ? AND obnumber == ? AND obname == ? AND satname == ? "
+        "AND varname == ? AND level == ?"
+    )
+    update = "UPDATE obsmon SET " + ",".join([tab + "=?" for tab in tabs]) + where
+    insert = "INSERT INTO obsmon VALUES(" + ",".join(["?"] * (7 + len(tabs))) + ")"
+    totals = [itab for itab, tab in enumerate(tabs) if tab.endswith("_total")]
+    update_totals = "UPDATE obsmon SET " + ",".join([tabs[itab] + "=?" for itab in totals]) + where
+    missing_laf = sums[("total", "laf", "missing")] > 0
+
+    cursor = conn.cursor()
+    for irow, key in enumerate(keys):
+        values = [column[irow] for column in columns]
+        if missing_laf[irow]:
+            if len(totals) > 0:
+                cursor.execute(update_totals, [values[itab] for itab in totals] + list(key))
+                exists = cursor.rowcount > 0
+            else:
+                exists = cursor.execute("SELECT 1 FROM obsmon" + where, key).fetchone()
+            if not exists:
+                values = [values[itab] if itab in totals else None for itab in range(len(tabs))]
+                cursor.execute(insert, list(key) + [0] + values)
+            continue
+        cursor.execute(update, values + list(key))
+        if cursor.rowcount == 0:
+            cursor.execute(insert, list(key) + [0] + values)
+
+    # Save (commit) the changes
+    conn.commit()
+    if missing_laf.any():
+        logging.warning(
+            "Land and sea statistics kept for %s obsmon rows with usage without laf",
+            np.count_nonzero(missing_laf)
+        )
+    logging.info("Recomputed %s obsmon rows", len(keys))
+    return len(keys), skipped
+
+
+def publish_staged_db(conn, staged_dbname, dtg, obsmon_variables):
+    """Copy a staged data base into a shared data base in one transaction.
+
+    The usage, obsmon, histogram and station statistics rows for the DTG and
+    the obsmon variables are replaced.
+
+    Args:
+        conn (sqlite3.connect): Connection to the shared data base.
+        staged_dbname (str): Staged data base.
+        dtg (str): Date time group.
+        obsmon_variables (list): Obsmon variables in the staged data base.
+
+    """
+    logging.info("Publish %s", staged_dbname)
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute("ATTACH DATABASE ? AS staged", (staged_dbname,))
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            where = (
+                " WHERE DTG == ? AND obnumber == ? AND obname == ? AND satname == ? "
+                "AND varname == ? AND level == ?"
+            )
+            for obsmon_variable in obsmon_variables:
+                key = (
+                    int(dtg), obsmon_variable.obnumber, obsmon_variable.obname,
+                    obsmon_variable.satname, obsmon_variable.varname, obsmon_variable.level
+                )
+                cursor.execute("DELETE FROM main.usage" + where, key)
+                cursor.execute("DELETE FROM main.obsmon" + where, key)
+                cursor.execute("DELETE FROM main.histogram" + where, key)
+            for table in ["usage", "obsmon", "histogram"]:
+                cols = ",".join([
+                    row[1] for row in
+                    cursor.execute(f"PRAGMA staged.table_info({table})").fetchall()
+                ])
+                cursor.execute(
+                    f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM staged.{table}"
+                )
+            merge_station_stats(
+                cursor, dtg, "staged.station_stats", station_keys(obsmon_variables)
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        cursor.execute("DETACH DATABASE staged")
+        conn.isolation_level = isolation_level
+    logging.info("Published %s", staged_dbname)
+
+
+def write_obsmon_sqlite_file(obsmon_data, obsmon_variables, dtg, dbname, concurrent=False,
+                             timeout=60.0, retries=5, stage_dir=None):
+    """Write obsmon sqlite file.
+
+    With concurrent, the rows are first written to a private staging data
+    base and then published to dbname with one short transaction in WAL
+    mode, so several writers can share the data base.
+
+    Args:
+        obsmon_data (pd.DataFrame|dict): Observation columns.
+        obsmon_variables (list): Obsmon variables.
+        dtg (str): Date time group.
+        dbname (str): Data base file.
+        concurrent (bool, optional): Stage and publish. Defaults to False.
+        timeout (float, optional): Seconds to wait for a locked data base.
+                                   Defaults to 60.
+        retries (int, optional): Publish attempts if the data base is locked.
+                                 Defaults to 5.
+        stage_dir (str, optional): Directory for the staging data base.
+                                   Defaults to None (system temporary directory).
+
+    Raises:
+        sqlite3.OperationalError: Data base still locked after the retries
+
+    """
+
+    modes = MODES
+    stat_cols = STAT_COLS
+    if concurrent:
+        with tempfile.TemporaryDirectory(dir=stage_dir) as tmpdir:
+            staged_dbname = os.path.join(tmpdir, "staged.db")
+            write_obsmon_sqlite_file(obsmon_data, obsmon_variables, dtg, staged_dbname)
+            for attempt in range(retries):
+                conn = None
+                try:
+                    conn = open_db(dbname, timeout=timeout, wal=True)
+                    create_db(conn, modes, stat_cols)
+                    publish_staged_db(conn, staged_dbname, dtg, obsmon_variables)
+                    break
+                except sqlite3.OperationalError as exc:
+                    if "locked" not in str(exc) and "busy" not in str(exc):
+                        raise
+                    if attempt == retries - 1:
+                        raise
+                    logging.warning("%s is locked, retry %s: %s", dbname, attempt + 1, exc)
+                    time.sleep(2**attempt * 0.1)
+                finally:
+                    if conn is not None:
+                        close_db(conn)
+        return
+
     conn = open_db(dbname)
     create_db(conn, modes, stat_cols)
 
-    populate_usage_db(conn, dtg, obsmon_data)
+    populate_usage_db(conn, dtg, obsmon_data, obsmon_variables)
+    populate_station_db(conn, dtg, obsmon_data, obsmon_variables)
+    populate_histogram_db(conn, dtg, obsmon_data, modes, obsmon_variables)
     populate_obsmon_db(
         conn,
         dtg,
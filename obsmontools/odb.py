@@ -1,9 +1,42 @@
 """ODB handling."""
+import os
+from contextlib import suppress
+
+import numpy as np
+import pandas as pd
 import pyodc as odc
 
 from .obsmon import ObsmonVariable
 
 
+ODB_RENAME = {
+    'fg_depar@body': 'fg_dep',
+    'an_depar@body': 'an_dep',
+    'lon@hdr': 'lon',
+    'lat@hdr': 'lat',
+    'statid@hdr': 'stid',
+    'obsvalue@body': 'value',
+    'datum_status@body': 'flag',
+    'lsm@modsurf': 'laf',
+    'datum_anflag@body': 'anflag',
+}
+
+USAGE_COLUMNS = [
+    "lon", "lat", "stid", "value", "fg_dep", "an_dep", "flag", "laf", "biascrl", "anflag"
+]
+
+ODB_COLUMNS = list(ODB_RENAME) + [
+    "obstype@hdr",
+    "codetype@hdr",
+    "varno@body",
+    "sensor@hdr",
+    "satellite_identifier@sat",
+    "vertco_reference_1@body",
+    "vertco_reference_2@body",
+    "biascorr@body",
+]
+
+
 class ODBObsmonVariable(ObsmonVariable):
 
     def __init__(self, tag, varname, obnumber, obname, view, satname="undefined", level=None):
@@ -51,22 +84,9 @@ class ODBObsmonData():
         else:
             raise NotImplementedError(self.view)
 
-        observations = observations.rename(
-            columns={
-                'fg_depar@body': 'fg_dep',
-                'an_depar@body': 'an_dep',
-                'lon@hdr': 'lon',
-                'lat@hdr': 'lat',
-                'statid@hdr': 'stid',
-                'obsvalue@body': 'value',
-                'datum_status@body': 'flag',
-                'lsm@modsurf': 'laf',
-                'datum_anflag@body': 'anflag',
-            })
-
-        observations = observations[[
-            "lon", "lat", "stid", "value", "fg_dep", "an_dep", "flag", "laf", "biascrl", "anflag" 
-        ]]
+        observations = observations.rename(columns=ODB_RENAME)
+
+        observations = observations[USAGE_COLUMNS]
 
         osize = len(observations)
         extra = {
@@ -95,16 +115,114 @@ class ODBObsmonData():
             raise RuntimeError("Instrument is not on board this satelite?")
         return self.config["instrument_ids"][self.instrument]
 
+    def get_view_arrays(self, arrays):
+        """Get the view from decoded ODB columns without building a DataFrame.
+
+        The view filters are applied as one fused mask and each needed column
+        is indexed once.
+
+        Args:
+            arrays (dict): Decoded ODB columns as numpy arrays.
+
+        Returns:
+            dict: Observation columns as numpy arrays.
+
+        """
+        mask = self.view_mask(arrays)
+        osize = int(np.count_nonzero(mask))
+
+        rename = dict(ODB_RENAME)
+        if self.view in ["mwrad", "irrad"]:
+            rename.update({"biascorr@body": "biascrl"})
+        defaults = {
+            "conv": {"biascrl": 0.0},
+            "amv": {"biascrl": 0.0, "laf": 0, "stid": "NA"},
+            "irrad": {"stid": "NA"},
+            "scatt": {"biascrl": 0.0, "laf": 0, "stid": "NA"},
+        }.get(self.view, {})
+
+        observations = {}
+        for odb_col, col in rename.items():
+            if col not in defaults and odb_col in arrays:
+                observations[col] = arrays[odb_col][mask]
+        for col, value in defaults.items():
+            observations[col] = np.full(osize, value)
+        for col in USAGE_COLUMNS:
+            if col not in observations:
+                raise KeyError(f"Column {col} is missing for view {self.view}")
+        observations = {col: observations[col] for col in USAGE_COLUMNS}
+
+        observations.update({
+            "varname": np.full(osize, self.obsmon_variable.varname),
+            "obname": np.full(osize, self.obsmon_variable.obname),
+            "obnumber": np.full(osize, self.obsmon_variable.obnumber),
+            "satname": np.full(osize, self.obsmon_variable.satname),
+            "level": np.full(osize, self.obsmon_variable.level),
+        })
+        # Mark observation as passive
+        if np.isin(observations["flag"], [3, 5, 7]).any():
+            self.passive = True
+
+        return observations
+
+    def view_mask(self, columns):
+        """Boolean mask selecting the observations in the view.
+
+        Args:
+            columns (pd.DataFrame|dict): Decoded ODB columns.
+
+        Returns:
+            np.ndarray: Mask
+
+        """
+        if self.view in ["conv", "amv"]:
+            mask = self.type_mask(columns)
+            if self.codetypes is not None:
+                mask &= np.isin(columns["codetype@hdr"], self.codetypes)
+        elif self.view in ["mwrad", "irrad"]:
+            if self.satelite_id is None or self.instrument_id is None or self.channel is None:
+                raise RuntimeError("Needed sensor information is missing")
+            mask = (
+                self.type_mask(columns) &
+                (np.asarray(columns["sensor@hdr"]) == self.instrument_id) &
+                (np.asarray(columns["satellite_identifier@sat"]) == self.satelite_id) &
+                (np.asarray(columns["vertco_reference_1@body"]) == self.channel) &
+                (np.asarray(columns["an_depar@body"]) > self.missing)
+            )
+        elif self.view == "scatt":
+            mask = self.type_mask(columns) & (np.asarray(columns["an_depar@body"]) > self.missing)
+            if self.satelite_id is not None:
+                mask &= np.asarray(columns["satellite_identifier@sat"]) == self.satelite_id
+        elif self.view == "radar":
+            mask = (
+                self.type_mask(columns) &
+                (np.asarray(columns["vertco_reference_2@body"]) == self.level) &
+                (np.asarray(columns["an_depar@body"]) > self.missing)
+            )
+            if self.codetypes is not None:
+                mask &= np.isin(columns["codetype@hdr"], self.codetypes)
+        else:
+            raise NotImplementedError(self.view)
+        return mask
+
+    def type_mask(self, columns):
+        """Mask for observation type and variable number.
+
+        Args:
+            columns (pd.DataFrame|dict): Decoded ODB columns.
+
+        Returns:
+            np.ndarray: Mask
+
+        """
+        return (
+            (np.asarray(columns["obstype@hdr"]) == self.obstype) &
+            (np.asarray(columns["varno@body"]) == self.varno)
+        )
+
     def filter_odb_conv_data(self, df_decoded):
 
-        observations = df_decoded[
-            (df_decoded["obstype@hdr"] == self.obstype) &
-            (df_decoded["varno@body"] == self.varno)
-        ]
-        if self.codetypes is not None:
-            observations = observations[
-                (observations["codetype@hdr"].isin(self.codetypes))
-            ]
+        observations = df_decoded[self.view_mask(df_decoded)]
         osize = len(observations)
         extra = {
             "biascrl": [0.0 for i in range(0,osize)],
@@ -114,14 +232,7 @@ class ODBObsmonData():
 
     def filter_odb_amv_data(self, df_decoded):
 
-        observations = df_decoded[
-            (df_decoded["obstype@hdr"] == self.obstype) &
-            (df_decoded["varno@body"] == self.varno)
-        ]
-        if self.codetypes is not None:
-            observations = observations[
-                (observations["codetype@hdr"].isin(self.codetypes))
-            ]
+        observations = df_decoded[self.view_mask(df_decoded)]
         osize = len(observations)
         extra = {
             "biascrl": [0.0 for i in range(0,osize)],
@@ -133,18 +244,8 @@ class ODBObsmonData():
 
     def filter_odb_mwrad_data(self, df_decoded):
 
-        if self.satelite_id is None or self.instrument_id is None or self.channel is None:
-            raise RuntimeError("Needed sensor information is missing")
-
         # odc header
-        observations = df_decoded[
-            (df_decoded["obstype@hdr"] == self.obstype) &
-            (df_decoded["varno@body"] == self.varno) &
-            (df_decoded["sensor@hdr"] == self.instrument_id) &
-            (df_decoded["satellite_identifier@sat"] == self.satelite_id) &
-            (df_decoded["vertco_reference_1@body"] == self.channel) &
-            (df_decoded["an_depar@body"] > self.missing)
-        ]
+        observations = df_decoded[self.view_mask(df_decoded)]
         observations = observations.rename(columns={
             'biascorr@body': 'biascrl',
         })
@@ -152,18 +253,8 @@ class ODBObsmonData():
 
     def filter_odb_irrad_data(self, df_decoded):
 
-        if self.satelite_id is None or self.instrument_id is None or self.channel is None:
-            raise RuntimeError("Needed sensor information is missing")
-
         # odc header
-        observations = df_decoded[
-            (df_decoded["obstype@hdr"] == self.obstype) &
-            (df_decoded["varno@body"] == self.varno) &
-            (df_decoded["sensor@hdr"] == self.instrument_id) &
-            (df_decoded["satellite_identifier@sat"] == self.satelite_id) &
-            (df_decoded["vertco_reference_1@body"] == self.channel) &
-            (df_decoded["an_depar@body"] > self.missing)
-        ]
+        observations = df_decoded[self.view_mask(df_decoded)]
         observations = observations.rename(columns={
             'biascorr@body': 'biascrl',
         })
@@ -176,16 +267,7 @@ class ODBObsmonData():
 
     def filter_odb_scatt_data(self, df_decoded):
 
-        observations = df_decoded[
-            (df_decoded["obstype@hdr"] == self.obstype) &
-            (df_decoded["varno@body"] == self.varno) &
-            (df_decoded["an_depar@body"] > self.missing)
-        ]
-
-        if self.satelite_id is not None:
-            observations = df_decoded[
-                (df_decoded["satellite_identifier@sat"] == self.satelite_id)
-            ]
+        observations = df_decoded[self.view_mask(df_decoded)]
         osize = len(observations)
         extra = {
             "biascrl": [0.0 for i in range(0,osize)],
@@ -197,19 +279,148 @@ class ODBObsmonData():
 
     def filter_odb_radar_data(self, df_decoded):
 
-        observations = df_decoded[
-            (df_decoded["obstype@hdr"] == self.obstype) &
-            (df_decoded["varno@body"] == self.varno) &
-            (df_decoded["vertco_reference_2@body"] == self.level) &
-            (df_decoded["an_depar@body"] > self.missing)
-        ]
-        if self.codetypes is not None:
-            observations = df_decoded[
-                (df_decoded["codetype@hdr"].isin(self.codetypes))
-            ]
+        observations = df_decoded[self.view_mask(df_decoded)]
         return observations
 
 
 def get_odb_data_from_file(odb_file):
     df_decoded = odc.read_odb(odb_file, single=True)
     return df_decoded
+
+
+def get_odb_arrays_from_file(odb_file, columns=None):
+    """Decode ODB columns into numpy arrays.
+
+    Frames are decoded one by one and only the requested columns present in
+    all frames are kept.
+
+    Args:
+        odb_file (str): ODB file.
+        columns (list, optional): Columns to decode. Defaults to None (all).
+
+    Returns:
+        dict: Column name and numpy array.
+
+    """
+    frames = odc.Reader(odb_file).frames
+    if len(frames) == 0:
+        return {}
+    available = set(frames[0].column_dict)
+    for frame in frames[1:]:
+        available &= set(frame.column_dict)
+    if columns is None:
+        columns = [col for col in frames[0].column_dict if col in available]
+    else:
+        columns = [col for col in columns if col in available]
+
+    parts = {col: [] for col in columns}
+    for frame in frames:
+        df_frame = frame.dataframe(columns)
+        for col in columns:
+            parts[col].append(df_frame[col].to_numpy())
+        del df_frame
+
+    arrays = {}
+    for col, values in parts.items():
+        values = values[0] if len(values) == 1 else np.concatenate(values)
+        if values.dtype == object:
+            values[pd.isnull(values)] = None
+        arrays[col] = values
+    return arrays
+
+
+def concat_arrays(views):
+    """Concatenate observation columns.
+
+    Args:
+        views (list): Observation columns (dict) from get_view_arrays.
+
+    Returns:
+        dict: Concatenated observation columns.
+
+    """
+    return {col: np.concatenate([view[col] for view in views]) for col in views[0]}
+
+
+def get_obsmon_data_from_odb_files(run_settings, config, odb_config, datapath, suffix,
+                                   engine="pandas", skip_missing=False):
+    """Read the ODB bases in datapath and extract the obsmon views.
+
+    Args:
+        run_settings (dict): ODB bases and the obsmon variables in each of them.
+        config (dict): Obsmon configuration.
+        odb_config (dict): ODB configuration.
+        datapath (str): Directory with the ODB files.
+        suffix (str): Suffix of the ODB files.
+        engine (str, optional): "pandas" or "numpy". Defaults to "pandas".
+        skip_missing (bool, optional): Continue with the next base if a base is
+                                       missing. Defaults to False which stops
+                                       at the first missing base.
+
+    Raises:
+        NotImplementedError: Unknown engine
+
+    Returns:
+        tuple: Observations (pd.DataFrame, dict of numpy arrays or None) and
+               list of ODBObsmonVariable.
+
+    """
+    if engine not in ["pandas", "numpy"]:
+        raise NotImplementedError(engine)
+
+    obsmon_data = None
+    obsmon_vars = []
+    views = []
+    for base in run_settings:
+        odb_file = f"{datapath}/{base}.{suffix}"
+        print(f"Opening {odb_file}")
+
+        if os.path.exists(odb_file) and os.path.getsize(odb_file) > 0:
+            if engine == "numpy":
+                odb_data = get_odb_arrays_from_file(odb_file, columns=ODB_COLUMNS)
+            else:
+                odb_data = get_odb_data_from_file(odb_file)
+        else:
+            print(f"File {odb_file} is missing or empty")
+            if skip_missing:
+                continue
+            break
+
+        for var in run_settings[base]:
+            varname = config[var]["varname"]
+            obnumber = config[var]["obnumber"]
+            obname = config[var]["obname"]
+            try:
+                satelites = config[var]["satelites"]
+            except KeyError:
+                satelites = ["undefined"]
+            levels = [0]
+            with suppress(KeyError):
+                levels = config[var]["channels"]
+            with suppress(KeyError):
+                levels = config[var]["levels"]
+
+            print(base, varname, obnumber, obname, satelites, levels)
+            for satelite in satelites:
+                for level in levels:
+                    obvar = ODBObsmonVariable(
+                        var, varname, obnumber, obname, base,
+                        satname=satelite, level=level
+                    )
+                    with suppress(KeyError):
+                        obvar.bin_widths = config[var]["histogram_bin_widths"]
+                    with suppress(KeyError):
+                        obvar.thinning = config[var]["thinning"]
+                    if engine == "numpy":
+                        views.append(ODBObsmonData(odb_config, obvar).get_view_arrays(odb_data))
+                        obsmon_vars.append(obvar)
+                        continue
+                    obsmon_data2 = ODBObsmonData(odb_config, obvar).get_view(odb_data)
+                    if obsmon_data is None:
+                        obsmon_data = obsmon_data2
+                    else:
+                        obsmon_data = pd.concat([obsmon_data, obsmon_data2])
+                    obsmon_vars.append(obvar)
+    if len(views) > 0:
+        obsmon_data = concat_arrays(views)
+    return obsmon_data, obsmon_vars
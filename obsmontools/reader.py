@@ -0,0 +1,388 @@
+"""Read obsmon data bases."""
+import os
+import glob
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from .obsmon import open_db, close_db
+
+
+class QueryCache():
+    """Least recently used cache of query results bounded by memory."""
+
+    def __init__(self, max_bytes=256 * 1024**2):
+        """Construct the cache.
+
+        Args:
+            max_bytes (int, optional): Memory limit in bytes. Defaults to 256 MB.
+
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def size(result):
+        """Approximate memory used by a result.
+
+        Args:
+            result (dict): Columns.
+
+        Returns:
+            int: Bytes.
+
+        """
+        nbytes = 0
+        for values in result.values():
+            nbytes += values.nbytes
+            if values.dtype == object:
+                nbytes += sum(len(str(value)) for value in values)
+        return nbytes
+
+    def get(self, key):
+        """Get a result and mark it as recently used.
+
+        Args:
+            key (tuple): Query key.
+
+        Returns:
+            dict: Columns or None if not cached.
+
+        """
+        try:
+            result, nbytes = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = (result, nbytes)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Store a result and evict the least recently used ones.
+
+        Args:
+            key (tuple): Query key.
+            result (dict): Columns.
+
+        """
+        nbytes = self.size(result)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (result, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, old_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= old_nbytes
+
+    def clear(self):
+        """Empty the cache."""
+        self.entries.clear()
+        self.nbytes = 0
+
+
+class ObsmonReader():
+    """Read-only access to one or many obsmon data bases.
+
+    Connections are pooled across the files, files outside the requested DTG
+    range are skipped and results are kept in a memory bounded LRU cache. A
+    result is a dict of numpy arrays which can be passed to pd.DataFrame.
+
+    """
+
+    def __init__(self, dbnames, max_connections=32, cache_bytes=256 * 1024**2):
+        """Construct the reader.
+
+        Args:
+            dbnames (str|list): Data base files or a glob pattern.
+            max_connections (int, optional): Open connections kept. Defaults to 32.
+            cache_bytes (int, optional): Memory limit of the cache. Defaults to 256 MB.
+
+        """
+        if isinstance(dbnames, str):
+            dbnames = sorted(glob.glob(dbnames))
+        self.dbnames = list(dbnames)
+        self.max_connections = max_connections
+        self.connections = OrderedDict()
+        self.dtg_ranges = {}
+        self.table_columns = {}
+        self.cache = QueryCache(cache_bytes)
+
+    def connection(self, dbname):
+        """Get a pooled read-only connection.
+
+        Args:
+            dbname (str): Data base file.
+
+        Returns:
+            sqlite3.connect: A connection
+
+        """
+        conn = self.connections.pop(dbname, None)
+        if conn is None:
+            conn = open_db(dbname, readonly=True)
+        self.connections[dbname] = conn
+        while len(self.connections) > self.max_connections:
+            _, old_conn = self.connections.popitem(last=False)
+            close_db(old_conn)
+        return conn
+
+    def close(self):
+        """Close all connections."""
+        while self.connections:
+            close_db(self.connections.popitem()[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def version(dbname):
+        """Version of a data base file.
+
+        In WAL mode commits go to the -wal file, so it is included.
+
+        Args:
+            dbname (str): Data base file.
+
+        Returns:
+            tuple: Modification time and size of the file and of its -wal file.
+
+        """
+        version = []
+        for filename in [dbname, dbname + "-wal"]:
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                version += [None, None]
+            else:
+                version += [stat.st_mtime_ns, stat.st_size]
+        return tuple(version)
+
+    def dtg_range(self, dbname):
+        """DTG range in a data base.
+
+        Args:
+            dbname (str): Data base file.
+
+        Returns:
+            tuple: First and last DTG or None if empty.
+
+        """
+        version = self.version(dbname)
+        try:
+            cached_version, dtgs = self.dtg_ranges[dbname]
+            if cached_version == version:
+                return dtgs
+        except KeyError:
+            pass
+        first, last = self.connection(dbname).execute(
+            "SELECT MIN(DTG), MAX(DTG) FROM obsmon"
+        ).fetchone()
+        dtgs = None if first is None else (first, last)
+        self.dtg_ranges[dbname] = (version, dtgs)
+        return dtgs
+
+    def columns(self, dbname, table):
+        """Columns in a table.
+
+        Args:
+            dbname (str): Data base file.
+            table (str): Table.
+
+        Returns:
+            list: Column names. Empty if the table does not exist.
+
+        """
+        version = self.version(dbname)
+        try:
+            cached_version, columns = self.table_columns[(dbname, table)]
+            if cached_version == version:
+                return columns
+        except KeyError:
+            pass
+        columns = [
+            row[1] for row in
+            self.connection(dbname).execute(f"PRAGMA table_info({table})").fetchall()
+        ]
+        self.table_columns[(dbname, table)] = (version, columns)
+        return columns
+
+    def read(self, table, dtg_range, columns=None, **filters):
+        """Read rows from a table in all data bases.
+
+        The data bases may have different schemas. By default the columns
+        present in all of them are read. A requested column missing in a data
+        base is read as NULL, and a data base missing a filtered column is
+        skipped.
+
+        Args:
+            table (str): "usage", "obsmon" or "histogram".
+            dtg_range (str|int|tuple): DTG or first and last DTG (inclusive).
+            columns (list, optional): Columns to read. Defaults to None (all).
+            filters: Column values to select. None selects all.
+
+        Raises:
+            NotImplementedError: Unknown table
+            KeyError: Unknown column
+
+        Returns:
+            dict: Column name and numpy array.
+
+        """
+        if table not in ["usage", "obsmon", "histogram"]:
+            raise NotImplementedError(table)
+        if isinstance(dtg_range, (str, int)):
+            dtg_range = (dtg_range, dtg_range)
+        first, last = int(dtg_range[0]), int(dtg_range[1])
+        filters = {col: value for col, value in filters.items() if value is not None}
+
+        dbnames = []
+        for dbname in self.dbnames:
+            dtgs = self.dtg_range(dbname)
+            if dtgs is not None and dtgs[0] <= last and dtgs[1] >= first:
+                dbnames.append(dbname)
+        schemas = {dbname: self.columns(dbname, table) for dbname in dbnames}
+
+        known = set()
+        for available in schemas.values():
+            known.update(available)
+        if columns is None:
+            present = [available for available in schemas.values() if len(available) > 0]
+            columns = [
+                col for col in (present[0] if present else [])
+                if all(col in available for available in present)
+            ]
+        elif len(dbnames) > 0:
+            for col in columns:
+                if col not in known:
+                    raise KeyError(f"Column {col} is not in {table}")
+        if len(dbnames) > 0:
+            for col in filters:
+                if col not in known:
+                    raise KeyError(f"Column {col} is not in {table}")
+
+        # DTG first to use the (DTG,...) indices
+        where = " WHERE DTG BETWEEN ? AND ?"
+        params = [first, last]
+        for col, value in filters.items():
+            where = where + " AND " + col + " == ?"
+            params.append(value)
+        commands = []
+        for dbname, available in schemas.items():
+            if not all(col in available for col in ["DTG"] + list(filters)):
+                continue
+            select = ",".join([col if col in available else "NULL" for col in columns])
+            commands.append((dbname, "SELECT " + select + " FROM " + table + where))
+
+        # File versions invalidate results from updated data bases
+        key = (
+            tuple(columns),
+            tuple(params),
+            tuple((dbname, cmd, self.version(dbname)) for dbname, cmd in commands),
+        )
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        rows = []
+        for dbname, cmd in commands:
+            logging.debug("%s %s %s", dbname, cmd, params)
+            rows.extend(self.connection(dbname).execute(cmd, params).fetchall())
+        if len(rows) > 0:
+            values = list(zip(*rows))
+        else:
+            values = [[] for col in columns]
+        result = {}
+        for col, col_values in zip(columns, values):
+            array = np.array(col_values)
+            if array.dtype == object:
+                # NULL in numeric columns
+                try:
+                    array = np.array(col_values, dtype=float)
+                except (TypeError, ValueError):
+                    pass
+            array.flags.writeable = False
+            result[col] = array
+        self.cache.put(key, result)
+        return result
+
+    def read_usage(self, dtg_range, obname=None, varname=None, level=None, satname=None,
+                   columns=None):
+        """Read observation usage.
+
+        Args:
+            dtg_range (str|int|tuple): DTG or first and last DTG (inclusive).
+            obname (str, optional): Observation name. Defaults to None (all).
+            varname (str, optional): Variable name. Defaults to None (all).
+            level (int, optional): Level or channel. Defaults to None (all).
+            satname (str, optional): Satellite name. Defaults to None (all).
+            columns (list, optional): Columns to read. Defaults to None (all).
+
+        Returns:
+            dict: Column name and numpy array.
+
+        """
+        return self.read("usage", dtg_range, columns=columns, obname=obname,
+                         varname=varname, level=level, satname=satname)
+
+    def read_obsmon(self, dtg_range, obname=None, varname=None, level=None, satname=None,
+                    columns=None):
+        """Read obsmon statistics.
+
+        Args:
+            dtg_range (str|int|tuple): DTG or first and last DTG (inclusive).
+            obname (str, optional): Observation name. Defaults to None (all).
+            varname (str, optional): Variable name. Defaults to None (all).
+            level (int, optional): Level or channel. Defaults to None (all).
+            satname (str, optional): Satellite name. Defaults to None (all).
+            columns (list, optional): Columns to read. Defaults to None (all).
+
+        Returns:
+            dict: Column name and numpy array.
+
+        """
+        return self.read("obsmon", dtg_range, columns=columns, obname=obname,
+                         varname=varname, level=level, satname=satname)
+
+    def read_histogram(self, dtg_range, quantity, obname=None, varname=None, level=None,
+                       satname=None, mode="total"):
+        """Read a histogram added over the DTG range.
+
+        Args:
+            dtg_range (str|int|tuple): DTG or first and last DTG (inclusive).
+            quantity (str): "fg_dep", "an_dep" or "obsvalue".
+            obname (str, optional): Observation name. Defaults to None (all).
+            varname (str, optional): Variable name. Defaults to None (all).
+            level (int, optional): Level or channel. Defaults to None (all).
+            satname (str, optional): Satellite name. Defaults to None (all).
+            mode (str, optional): "total", "land" or "sea". Defaults to "total".
+
+        Returns:
+            dict: Lower bin edges (left), bin_width and count.
+
+        """
+        histogram = self.read(
+            "histogram", dtg_range, columns=["bin_width", "bin", "count"], obname=obname,
+            varname=varname, level=level, satname=satname, mode=mode, quantity=quantity
+        )
+        if len(histogram["bin"]) == 0:
+            return {"left": np.array([]), "bin_width": np.array([]), "count": np.array([])}
+        keys, inverse = np.unique(
+            np.column_stack([histogram["bin_width"], histogram["bin"]]), axis=0,
+            return_inverse=True
+        )
+        count = np.bincount(inverse.ravel(), weights=histogram["count"], minlength=len(keys))
+        return {
+            "left": keys[:, 0] * keys[:, 1],
+            "bin_width": keys[:, 0],
+            "count": count.astype(int),
+        }
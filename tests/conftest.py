@@ -0,0 +1,94 @@
+"""Shared fixtures."""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyodc as odc
+import pytest
+
+from obsmontools.obsmon import ObsmonVariable
+
+
+PACKAGE_DATA = os.path.join(os.path.dirname(__file__), "..", "obsmontools", "data")
+
+
+def write_conv_odb(odb_file, nobs=200, seed=0):
+    """Write a synthetic conventional ODB file with synop t2m and rh2m."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "obstype@hdr": np.full(nobs, 1, dtype=np.int32),
+        "codetype@hdr": np.full(nobs, 11, dtype=np.int32),
+        "varno@body": np.where(np.arange(nobs) % 2 == 0, 39, 58).astype(np.int32),
+        "statid@hdr": [f"{i % 17:05d}" for i in range(nobs)],
+        "lat@hdr": rng.uniform(50, 70, nobs),
+        "lon@hdr": rng.uniform(0, 30, nobs),
+        "obsvalue@body": rng.normal(280, 5, nobs),
+        "fg_depar@body": rng.normal(0, 1, nobs),
+        "an_depar@body": rng.normal(0, 0.5, nobs),
+        "datum_status@body": rng.choice([1, 3, 4, 5, 12], nobs).astype(np.int32),
+        "lsm@modsurf": rng.choice([0.0, 1.0, 0.5], nobs),
+        "datum_anflag@body": np.zeros(nobs, dtype=np.int32),
+    })
+    odc.encode_odb(df, odb_file)
+
+
+@pytest.fixture(scope="session")
+def obsmon_config():
+    with open(f"{PACKAGE_DATA}/obsmon_config.json", mode="r", encoding="utf8") as fhandler:
+        return json.load(fhandler)
+
+
+@pytest.fixture(scope="session")
+def odb_config():
+    with open(f"{PACKAGE_DATA}/odb_config.json", mode="r", encoding="utf8") as fhandler:
+        return json.load(fhandler)
+
+
+@pytest.fixture()
+def run_settings():
+    return {"conv": ["synop_t2m", "synop_rh2m"]}
+
+
+@pytest.fixture()
+def archive(tmp_path):
+    """Archive with one conventional cycle 2025110512."""
+    datapath = tmp_path / "archive" / "2025" / "11" / "05" / "12"
+    datapath.mkdir(parents=True)
+    write_conv_odb(str(datapath / "conv.mfb"))
+    return str(tmp_path / "archive")
+
+
+@pytest.fixture()
+def observations():
+    """Observation columns for synop t2m as returned by the numpy engine."""
+    rng = np.random.default_rng(1)
+    nobs = 300
+    value = rng.normal(280, 5, nobs)
+    fg_dep = rng.normal(0, 1, nobs)
+    an_dep = rng.normal(0, 0.5, nobs)
+    value[::50] = np.nan
+    fg_dep[::50] = np.nan
+    an_dep[::50] = np.nan
+    return {
+        "lon": rng.uniform(0, 30, nobs),
+        "lat": rng.uniform(50, 70, nobs),
+        "stid": np.array([f"{i % 7:05d}" for i in range(nobs)], dtype=object),
+        "value": value,
+        "fg_dep": fg_dep,
+        "an_dep": an_dep,
+        "flag": rng.choice([1, 3, 4, 5, 12], nobs),
+        "laf": rng.choice([0.0, 1.0, 0.5], nobs),
+        "biascrl": np.zeros(nobs),
+        "anflag": np.zeros(nobs, dtype=int),
+        "varname": np.full(nobs, "t2m"),
+        "obname": np.full(nobs, "synop"),
+        "obnumber": np.full(nobs, 1),
+        "satname": np.full(nobs, "undefined"),
+        "level": np.full(nobs, 0),
+    }
+
+
+@pytest.fixture()
+def obsmon_variables():
+    return [ObsmonVariable("synop_t2m", "t2m", 1, "synop", level=0)]
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+import time
+
+from obsmontools.daemon import ObsmonDaemon, archive_datapath, send_command
+
+
+def test_archive_datapath():
+    assert archive_datapath("/arch", "2025110512") == "/arch/2025/11/05/12"
+
+
+def test_daemon_skips_existing_cycles(archive, run_settings, obsmon_config, odb_config, tmp_path):
+    daemon = ObsmonDaemon(
+        run_settings, obsmon_config, odb_config, archive, "mfb",
+        str(tmp_path / "{dtg}.db"), settle=0
+    )
+    assert daemon.scan() == []
+
+
+def test_daemon_polls_incomplete_cycles(archive, run_settings, obsmon_config, odb_config,
+                                        tmp_path):
+    daemon = ObsmonDaemon(
+        run_settings, obsmon_config, odb_config, archive, "mfb",
+        str(tmp_path / "{dtg}.db"), settle=3600
+    )
+    assert "2025110512" not in daemon.processed
+    assert daemon.scan() == []
+    daemon.settle = 0
+    assert daemon.scan() == ["2025110512"]
+
+
+def test_daemon_scan(archive, run_settings, obsmon_config, odb_config, tmp_path):
+    daemon = ObsmonDaemon(
+        run_settings, obsmon_config, odb_config, archive, "mfb",
+        str(tmp_path / "{dtg}.db"), start_dtg="2025110500", settle=0
+    )
+    assert daemon.scan() == ["2025110512"]
+    assert daemon.scan() == []
+    with sqlite3.connect(str(tmp_path / "2025110512.db")) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM obsmon").fetchone()[0] == 2
+
+
+def test_daemon_control_socket(archive, run_settings, obsmon_config, odb_config, tmp_path):
+    control_socket = str(tmp_path / "ctl.sock")
+    daemon = ObsmonDaemon(
+        run_settings, obsmon_config, odb_config, archive, "mfb",
+        str(tmp_path / "{dtg}.db"), poll_interval=0.1, control_socket=control_socket
+    )
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        while not os.path.exists(control_socket):
+            time.sleep(0.01)
+        assert send_command(control_socket, "convert 2025110512") == "queued 2025110512"
+        assert send_command(control_socket, "status").startswith("processed")
+    finally:
+        send_command(control_socket, "stop")
+        thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert os.path.exists(str(tmp_path / "2025110512.db"))
+
+
+def test_daemon_failed_cycle_does_not_block(archive, run_settings, obsmon_config, odb_config,
+                                            tmp_path):
+    corrupt = tmp_path / "archive" / "2025" / "11" / "05" / "06"
+    corrupt.mkdir(parents=True)
+    (corrupt / "conv.mfb").write_bytes(b"not an odb file")
+    daemon = ObsmonDaemon(
+        run_settings, obsmon_config, odb_config, archive, "mfb",
+        str(tmp_path / "{dtg}.db"), start_dtg="2025110500", settle=0, max_attempts=2,
+        retry_delay=0
+    )
+    assert daemon.scan() == ["2025110512"]
+    assert daemon.failed["2025110506"][0] == 1
+    assert daemon.scan() == []
+    assert "2025110506" not in daemon.failed
+    assert "2025110506" in daemon.processed
+
+
+def test_daemon_waits_for_all_bases(archive, obsmon_config, odb_config, tmp_path):
+    run_settings = {"mwrad": ["amsua"], "conv": ["synop_t2m"]}
+    daemon = ObsmonDaemon(
+        run_settings, obsmon_config, odb_config, archive, "mfb",
+        str(tmp_path / "{dtg}.db"), start_dtg="2025110500", settle=0
+    )
+    assert daemon.scan() == []
+    assert "2025110512" not in daemon.processed
+    # On demand conversion skips the missing base
+    assert daemon.convert("2025110512")
+    with sqlite3.connect(str(tmp_path / "2025110512.db")) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM obsmon").fetchone()[0] == 1
@@ -0,0 +1,288 @@
+import sqlite3
+import threading
+
+import numpy as np
+
+from obsmontools.cli import usage2obsmon
+from obsmontools.obsmon import (
+    write_obsmon_sqlite_file, calculate_statistics, ObsmonVariable, MODES, STAT_COLS
+)
+from obsmontools.reader import ObsmonReader
+
+
+def test_station_statistics_incremental(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "obsmon.db")
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110500", dbname)
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname)
+    # Rewriting a DTG must not count it twice
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname)
+
+    with sqlite3.connect(dbname) as conn:
+        period = conn.execute(
+            "SELECT nobs, n_fg_dep, fg_dep_sum FROM station_stats_period "
+            "WHERE period == 202511 AND statid == '00003' AND varname == 't2m'"
+        ).fetchone()
+        dtg = conn.execute(
+            "SELECT nobs, n_fg_dep, fg_dep_sum FROM station_stats "
+            "WHERE DTG == 2025110512 AND statid == '00003'"
+        ).fetchone()
+        usage = conn.execute(
+            "SELECT COUNT(*), COUNT(fg_dep), SUM(fg_dep) FROM usage "
+            "WHERE DTG == 2025110500 AND statid == '00003'"
+        ).fetchone()
+
+    assert dtg[:2] == usage[:2]
+    np.testing.assert_allclose(dtg[2], usage[2])
+    assert period[:2] == (2 * usage[0], 2 * usage[1])
+    np.testing.assert_allclose(period[2], 2 * usage[2])
+
+
+def test_station_statistics_removed_station(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "obsmon.db")
+    for dtg in ["2025103112", "2025110512"]:
+        write_obsmon_sqlite_file(observations, obsmon_variables, dtg, dbname)
+    keep = observations["stid"] != "00003"
+    write_obsmon_sqlite_file(
+        {col: values[keep] for col, values in observations.items()}, obsmon_variables,
+        "2025110512", dbname
+    )
+
+    with sqlite3.connect(dbname) as conn:
+        periods = conn.execute(
+            "SELECT period FROM station_stats_period WHERE statid == '00003'"
+        ).fetchall()
+        assert conn.execute("SELECT MIN(nobs) FROM station_stats_period").fetchone()[0] > 0
+    assert periods == [(202510,)]
+
+
+def test_histograms(observations, obsmon_variables, tmp_path):
+    obsmon_variables[0].bin_widths = {"fg_dep": 0.5}
+    dbname = str(tmp_path / "obsmon.db")
+    for dtg in ["2025110500", "2025110512", "2025110512"]:
+        write_obsmon_sqlite_file(observations, obsmon_variables, dtg, dbname)
+
+    reader = ObsmonReader([dbname])
+    histogram = reader.read_histogram(
+        ("2025110500", "2025110512"), "fg_dep", obname="synop", varname="t2m", mode="sea"
+    )
+    sea = (observations["laf"] == 0) & ~np.isnan(observations["value"])
+    fg_dep = observations["fg_dep"][sea]
+    assert np.all(histogram["bin_width"] == 0.5)
+    assert histogram["count"].sum() == 2 * len(fg_dep)
+    bins, counts = np.unique(np.floor(fg_dep / 0.5), return_counts=True)
+    np.testing.assert_allclose(histogram["left"], bins * 0.5)
+    np.testing.assert_array_equal(histogram["count"], 2 * counts)
+    obsvalue = reader.read_histogram("2025110500", "obsvalue", varname="t2m")
+    assert np.all(obsvalue["bin_width"] == 1.0)
+    assert obsvalue["count"].sum() == np.count_nonzero(~np.isnan(observations["value"]))
+    reader.close()
+
+
+def test_usage2obsmon(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "obsmon.db")
+    for dtg in ["2025110500", "2025110512"]:
+        write_obsmon_sqlite_file(observations, obsmon_variables, dtg, dbname)
+    with ObsmonReader([dbname]) as reader:
+        usage = reader.read_usage("2025110512")
+        original = reader.read_obsmon(("2025110500", "2025110512"))
+    expected = calculate_statistics(
+        {"laf": usage["laf"], "value": usage["obsvalue"], "fg_dep": usage["fg_dep"],
+         "an_dep": usage["an_dep"]},
+        MODES, STAT_COLS
+    )
+
+    with sqlite3.connect(dbname) as conn:
+        conn.execute("DELETE FROM obsmon WHERE DTG == 2025110512")
+    usage2obsmon([dbname, "--first-dtg", "2025110500"])
+
+    with ObsmonReader([dbname]) as reader:
+        obsmon = reader.read_obsmon(("2025110500", "2025110512"))
+    assert obsmon["DTG"].tolist() == [2025110500, 2025110512]
+    for tab, value in expected.items():
+        np.testing.assert_allclose(obsmon[tab][1], value)
+        np.testing.assert_allclose(obsmon[tab][0], original[tab][0])
+
+
+def test_concurrent_writers(observations, tmp_path):
+    writers = []
+    for varname in ["t2m", "rh2m", "td2m", "u10m"]:
+        obsmon_data = dict(observations)
+        obsmon_data["varname"] = np.full(len(observations["value"]), varname)
+        obsmon_variable = ObsmonVariable(f"synop_{varname}", varname, 1, "synop", level=0)
+        writers.append((obsmon_data, [obsmon_variable]))
+
+    shared = str(tmp_path / "shared.db")
+    threads = [
+        threading.Thread(
+            target=write_obsmon_sqlite_file,
+            args=(obsmon_data, obsmon_variables, "2025110512", shared),
+            kwargs={"concurrent": True, "stage_dir": str(tmp_path)},
+        )
+        for obsmon_data, obsmon_variables in writers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Publishing twice replaces the rows
+    write_obsmon_sqlite_file(*writers[0], "2025110512", shared, concurrent=True)
+
+    sequential = str(tmp_path / "sequential.db")
+    for obsmon_data, obsmon_variables in writers:
+        write_obsmon_sqlite_file(obsmon_data, obsmon_variables, "2025110512", sequential)
+
+    with sqlite3.connect(shared) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    for table, order in [
+        ("obsmon", "varname"),
+        ("histogram", "varname, mode, quantity, bin"),
+        ("station_stats_period", "varname, statid"),
+    ]:
+        rows = {}
+        for dbname in [shared, sequential]:
+            with sqlite3.connect(dbname) as conn:
+                rows[dbname] = conn.execute(f"SELECT * FROM {table} ORDER BY {order}").fetchall()
+        assert len(rows[shared]) > 0
+        assert rows[shared] == rows[sequential]
+    with sqlite3.connect(shared) as conn:
+        nusage = conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0]
+    assert nusage == 4 * len(observations["value"])
+
+
+def test_usage_thinning(observations, obsmon_variables, tmp_path):
+    full = str(tmp_path / "full.db")
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", full)
+    obsmon_variables[0].thinning = {"grid": 5.0, "max_per_cell": 2}
+    thinned = str(tmp_path / "thinned.db")
+    for dbname in [thinned, str(tmp_path / "thinned2.db")]:
+        write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname)
+
+    with ObsmonReader([full]) as reader:
+        full_usage = reader.read_usage("2025110512")
+        full_obsmon = reader.read_obsmon("2025110512")
+    with ObsmonReader([thinned, str(tmp_path / "thinned2.db")]) as reader:
+        usage = reader.read_usage("2025110512")
+        obsmon = reader.read_obsmon("2025110512")
+
+    # Deterministic
+    nusage = len(usage["DTG"]) // 2
+    for col in ["latitude", "longitude", "weight"]:
+        np.testing.assert_array_equal(usage[col][:nusage], usage[col][nusage:])
+    usage = {col: values[:nusage] for col, values in usage.items()}
+
+    active = (full_usage["active"] == 1) & (full_usage["passive"] == 0) & \
+        (full_usage["rejected"] == 0) & (full_usage["blacklisted"] == 0)
+    kept_active = (usage["active"] == 1) & (usage["passive"] == 0) & \
+        (usage["rejected"] == 0) & (usage["blacklisted"] == 0)
+    assert nusage < len(full_usage["DTG"])
+    assert np.count_nonzero(~kept_active) == np.count_nonzero(~active)
+    assert np.all(usage["weight"][~kept_active] == 1)
+    np.testing.assert_allclose(usage["weight"][kept_active].sum(), np.count_nonzero(active))
+
+    # Statistics are computed from all observations
+    for tab in full_obsmon:
+        np.testing.assert_array_equal(obsmon[tab][:1], full_obsmon[tab])
+
+
+def test_usage2obsmon_rewritten_dtg(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "obsmon.db")
+    for _ in range(2):
+        write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname)
+    usage2obsmon([dbname])
+    with sqlite3.connect(dbname) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0] == \
+            len(observations["value"])
+        assert conn.execute("SELECT nobs_total FROM obsmon").fetchall() == \
+            [(len(observations["value"]),)]
+
+
+def test_concurrent_writer_retries_locked_open(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "locked.db")
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110500", dbname)
+    lock = sqlite3.connect(dbname, isolation_level=None, check_same_thread=False)
+    lock.execute("BEGIN EXCLUSIVE")
+    release = threading.Timer(0.3, lock.execute, args=("COMMIT",))
+    release.start()
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname,
+                             concurrent=True, timeout=0.01, retries=8,
+                             stage_dir=str(tmp_path))
+    release.join()
+    lock.close()
+    with sqlite3.connect(dbname) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM obsmon").fetchone()[0] == 2
+
+
+def test_usage2obsmon_skips_thinned(observations, obsmon_variables, tmp_path):
+    obsmon_variables[0].thinning = {"grid": 5.0, "max_per_cell": 2}
+    dbname = str(tmp_path / "thinned.db")
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname)
+    with sqlite3.connect(dbname) as conn:
+        original = conn.execute("SELECT * FROM obsmon").fetchall()
+
+    usage2obsmon([dbname])
+    with sqlite3.connect(dbname) as conn:
+        assert conn.execute("SELECT * FROM obsmon").fetchall() == original
+
+    usage2obsmon([dbname, "--thinned"])
+    with sqlite3.connect(dbname) as conn:
+        nobs = conn.execute("SELECT nobs_total FROM obsmon").fetchone()[0]
+    np.testing.assert_allclose(nobs, len(observations["value"]))
+
+
+def test_usage2obsmon_legacy_usage(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "legacy.db")
+    for dtg in ["2025110500", "2025110512"]:
+        write_obsmon_sqlite_file(observations, obsmon_variables, dtg, dbname)
+    with ObsmonReader([dbname]) as reader:
+        original = reader.read_obsmon(("2025110500", "2025110512"))
+    with sqlite3.connect(dbname) as conn:
+        conn.execute("UPDATE usage SET laf = NULL")
+        conn.execute("DELETE FROM obsmon WHERE DTG == 2025110512")
+    usage2obsmon([dbname])
+
+    with ObsmonReader([dbname]) as reader:
+        obsmon = reader.read_obsmon(("2025110500", "2025110512"))
+    assert obsmon["DTG"].tolist() == [2025110500, 2025110512]
+    for col in STAT_COLS:
+        np.testing.assert_allclose(obsmon[col + "_total"], original[col + "_total"])
+        # The updated row keeps land and sea, the inserted row has them undefined
+        for mode in ["land", "sea"]:
+            assert obsmon[col + "_" + mode][0] == original[col + "_" + mode][0]
+            assert np.isnan(obsmon[col + "_" + mode][1])
+
+
+def test_concurrent_writers_migrate_old_schema(observations, tmp_path):
+    for iteration in range(5):
+        shared = str(tmp_path / f"old{iteration}.db")
+        with sqlite3.connect(shared) as conn:
+            conn.execute(
+                "CREATE TABLE usage (DTG INT, obnumber INT, obname CHAR(20), "
+                "satname CHAR(20), varname CHAR(20), level INT, latitude FLOAT, longitude FLOAT, "
+                "statid CHAR(20), obsvalue FLOAT, fg_dep FLOAT, an_dep FLOAT, biascrl FLOAT, "
+                "active INT, rejected INT, passive INT, blacklisted INT, anflag INT)"
+            )
+        errors = []
+
+        def write(varname, shared=shared, errors=errors):
+            obsmon_data = dict(observations)
+            obsmon_data["varname"] = np.full(len(observations["value"]), varname)
+            obsmon_variable = ObsmonVariable(f"synop_{varname}", varname, 1, "synop", level=0)
+            try:
+                write_obsmon_sqlite_file(obsmon_data, [obsmon_variable], "2025110512", shared,
+                                         concurrent=True, stage_dir=str(tmp_path))
+            except Exception as exc:  # noqa
+                errors.append(exc)
+
+        threads = [
+            threading.Thread(target=write, args=(varname,))
+            for varname in ["t2m", "rh2m", "td2m", "u10m"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        with sqlite3.connect(shared) as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(usage)").fetchall()]
+            assert columns[-2:] == ["laf", "weight"]
+            assert conn.execute("SELECT COUNT(*) FROM obsmon").fetchone()[0] == 4
@@ -0,0 +1,48 @@
+import sqlite3
+
+import numpy as np
+
+from obsmontools.daemon import archive_datapath
+from obsmontools.odb import get_obsmon_data_from_odb_files
+from obsmontools.obsmon import write_obsmon_sqlite_file
+
+
+def test_numpy_engine_matches_pandas(archive, run_settings, obsmon_config, odb_config, tmp_path):
+    datapath = archive_datapath(archive, "2025110512")
+    tables = {}
+    for engine in ["pandas", "numpy"]:
+        obsmon_data, obsmon_vars = get_obsmon_data_from_odb_files(
+            run_settings, obsmon_config, odb_config, datapath, "mfb", engine=engine
+        )
+        if engine == "numpy":
+            assert isinstance(obsmon_data, dict)
+            assert isinstance(obsmon_data["fg_dep"], np.ndarray)
+        dbname = str(tmp_path / f"{engine}.db")
+        write_obsmon_sqlite_file(obsmon_data, obsmon_vars, "2025110512", dbname)
+        with sqlite3.connect(dbname) as conn:
+            tables[engine] = [
+                conn.execute(f"SELECT * FROM {table} ORDER BY varname, statid, latitude, longitude").fetchall()
+                if table == "usage" else
+                conn.execute(f"SELECT * FROM {table} ORDER BY varname").fetchall()
+                for table in ["usage", "obsmon"]
+            ]
+    assert len(tables["pandas"][0]) == 200
+    assert tables["pandas"] == tables["numpy"]
+
+
+def test_histogram_bin_widths_from_config(archive, run_settings, obsmon_config, odb_config,
+                                          tmp_path):
+    datapath = archive_datapath(archive, "2025110512")
+    obsmon_data, obsmon_vars = get_obsmon_data_from_odb_files(
+        run_settings, obsmon_config, odb_config, datapath, "mfb"
+    )
+    dbname = str(tmp_path / "obsmon.db")
+    write_obsmon_sqlite_file(obsmon_data, obsmon_vars, "2025110512", dbname)
+    with sqlite3.connect(dbname) as conn:
+        widths = dict(conn.execute(
+            "SELECT varname || ' ' || quantity, bin_width FROM histogram GROUP BY varname, quantity"
+        ).fetchall())
+    assert widths == {
+        "rh2m an_dep": 0.01, "rh2m fg_dep": 0.01, "rh2m obsvalue": 0.05,
+        "t2m an_dep": 0.1, "t2m fg_dep": 0.1, "t2m obsvalue": 1.0,
+    }
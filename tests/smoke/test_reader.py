@@ -0,0 +1,82 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from obsmontools.obsmon import write_obsmon_sqlite_file
+from obsmontools.reader import ObsmonReader
+
+
+@pytest.fixture()
+def dbnames(observations, obsmon_variables, tmp_path):
+    dbnames = []
+    for dtg in ["2025110500", "2025110512", "2025110600"]:
+        dbname = str(tmp_path / f"obsmon_{dtg}.db")
+        write_obsmon_sqlite_file(observations, obsmon_variables, dtg, dbname)
+        dbnames.append(dbname)
+    return dbnames
+
+
+def test_read_usage(dbnames, observations, tmp_path):
+    with ObsmonReader(str(tmp_path / "obsmon_*.db"), max_connections=2) as reader:
+        usage = reader.read_usage(
+            ("2025110500", "2025110512"), obname="synop", varname="t2m", level=0,
+            columns=["DTG", "fg_dep", "statid"]
+        )
+        assert len(reader.connections) == 2
+        assert set(usage) == {"DTG", "fg_dep", "statid"}
+        assert len(usage["DTG"]) == 2 * len(observations["value"])
+        assert set(usage["DTG"].tolist()) == {2025110500, 2025110512}
+        assert usage["fg_dep"].dtype == float
+        assert np.isnan(usage["fg_dep"]).sum() == 2 * np.isnan(observations["value"]).sum()
+
+        cached = reader.read_usage(
+            ("2025110500", "2025110512"), obname="synop", varname="t2m", level=0,
+            columns=["DTG", "fg_dep", "statid"]
+        )
+        assert cached is usage
+        assert reader.cache.hits == 1
+
+        assert len(reader.read_usage("2025110700")) == 0
+        with pytest.raises(KeyError):
+            reader.read_usage("2025110500", columns=["DTG; DROP TABLE usage"])
+
+
+def test_read_obsmon(dbnames):
+    reader = ObsmonReader(dbnames)
+    obsmon = reader.read_obsmon(2025110600, varname="t2m", columns=["DTG", "nobs_total"])
+    assert obsmon["DTG"].tolist() == [2025110600]
+    with pytest.raises(sqlite3.OperationalError):
+        reader.connection(dbnames[0]).execute("DELETE FROM obsmon")
+    reader.close()
+
+
+def test_cache_invalidated_by_wal_commit(observations, obsmon_variables, tmp_path):
+    dbname = str(tmp_path / "wal.db")
+    write_obsmon_sqlite_file(observations, obsmon_variables, "2025110512", dbname,
+                             concurrent=True)
+    with ObsmonReader([dbname]) as reader:
+        nobs = reader.read_obsmon("2025110512", columns=["nobs_total"])["nobs_total"][0]
+        assert nobs == len(observations["value"])
+        conn = sqlite3.connect(dbname)
+        conn.execute("UPDATE obsmon SET nobs_total = 1")
+        conn.commit()
+        assert reader.read_obsmon("2025110512", columns=["nobs_total"])["nobs_total"][0] == 1
+        conn.close()
+
+
+def test_read_mixed_schemas(dbnames):
+    with sqlite3.connect(dbnames[0]) as conn:
+        conn.execute("ALTER TABLE usage DROP COLUMN weight")
+        conn.execute("DROP TABLE histogram")
+    with ObsmonReader(dbnames) as reader:
+        # Cache the schema of the new files first
+        reader.read_usage("2025110600", columns=["DTG", "weight"])
+        usage = reader.read_usage(("2025110500", "2025110512"))
+        assert "weight" not in usage
+        weight = reader.read_usage(("2025110500", "2025110512"), columns=["DTG", "weight"])
+        old = weight["DTG"] == 2025110500
+        assert np.all(np.isnan(weight["weight"][old]))
+        assert np.all(weight["weight"][~old] == 1)
+        histogram = reader.read_histogram(("2025110500", "2025110600"), "fg_dep")
+        assert histogram["count"].sum() > 0